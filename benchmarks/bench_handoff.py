@@ -0,0 +1,56 @@
+''' Benchmark for handing EEG windows to the classifier process pool.
+
+Compares pickling the window into every task against passing a shared
+memory slot index (nicls.shared_window), reporting the pickled task size
+and the submit to result round trip.
+
+Usage: python bench_handoff.py [channels] [samples]
+'''
+import pickle
+import sys
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from nicls.shared_window import SharedWindowPool, attach_windows, worker_window
+
+
+def _touch(window):
+    if not isinstance(window, np.ndarray):
+        window = worker_window(window)
+    return float(window[::64].sum())
+
+
+def round_trip(pool, window, repeats):
+    pool.submit(_touch, window).result()  # warm up
+    t = time.perf_counter()
+    for _ in range(repeats):
+        pool.submit(_touch, window).result()
+    return (time.perf_counter() - t) / repeats
+
+
+def main(channels=128, samples=4096, repeats=50):
+    windows = SharedWindowPool(1, (samples, channels))
+    data = np.random.default_rng(0).standard_normal((samples, channels))
+    windows.array(0)[:] = data
+    config = {"samplerate": 2048, "freq_specs": [6, 180, 8],
+              "wavelet_width": 5}
+
+    pickled = len(pickle.dumps((data, config, (0, 1))))
+    shared = len(pickle.dumps((0, config, (0, 1))))
+
+    try:
+        with ProcessPoolExecutor(1, initializer=attach_windows,
+                                 initargs=windows.initargs()) as pool:
+            pickled_latency = round_trip(pool, data, repeats)
+            shared_latency = round_trip(pool, 0, repeats)
+    finally:
+        windows.close()
+
+    print(f"window {samples} samples x {channels} channels")
+    print(f"pickled window: {pickled:>10} bytes {pickled_latency * 1e3:8.3f} ms")
+    print(f"shared slot:    {shared:>10} bytes {shared_latency * 1e3:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,49 @@
+''' Micro-benchmark for decoding BioSemi packets.
+
+Compares the vectorized decoder in nicls.biosemi_listener against the
+original per sample int.from_bytes decoder, checks that both produce the
+same values, and prints packets / second for each.
+
+Usage: python bench_parse.py [channels ...]
+'''
+import sys
+import timeit
+import numpy as np
+
+from functools import partial
+from nicls.biosemi_listener import decode_samples, SAMPLES, WIDTH
+
+
+def legacy_decode(data, channels):
+    data = map(partial(int.from_bytes, byteorder="little", signed=True),
+               [data[i:i + WIDTH] for i in range(0, len(data), WIDTH)])
+    return np.array(list(data)).reshape(-1, channels)
+
+
+def make_packet(channels, samples=SAMPLES, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(-2**23, 2**23, size=samples * channels)
+    return b"".join(int(v).to_bytes(WIDTH, "little", signed=True)
+                    for v in values)
+
+
+def bench(channels, number=200):
+    packet = make_packet(channels)
+    if not np.array_equal(legacy_decode(packet, channels),
+                          decode_samples(packet, channels)):
+        raise AssertionError(f"decoders disagree at {channels} channels")
+
+    legacy = timeit.timeit(lambda: legacy_decode(packet, channels),
+                           number=number)
+    vectorized = timeit.timeit(lambda: decode_samples(packet, channels),
+                               number=number)
+    return number / legacy, number / vectorized
+
+
+if __name__ == "__main__":
+    channel_counts = [int(c) for c in sys.argv[1:]] or [32, 64, 128, 256]
+    print(f"{'channels':>8} {'legacy pkt/s':>14} {'numpy pkt/s':>14} {'speedup':>8}")
+    for channels in channel_counts:
+        legacy, vectorized = bench(channels)
+        print(f"{channels:>8} {legacy:>14.0f} {vectorized:>14.0f} "
+              f"{vectorized / legacy:>7.1f}x")
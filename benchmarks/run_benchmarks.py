@@ -0,0 +1,267 @@
+''' Benchmark suite for the acquisition to result hot path.
+
+Times each stage on synthetic data and writes the results as JSON, so
+runs on different commits or configs can be compared:
+    parse: BioSemiListener.parse in packets / second, by channel count
+        and packets decoded per call
+    powers: Classifier.powers, by window length, channels and frequencies
+    pool: process pool round trip of a shared memory window, minus the
+        time spent computing in the worker
+    predict: LinearModel.probability in epochs / second, by epochs
+        scored per call
+    statistics: OnlineStatistics.update in vectors / second, by feature
+        count and vectors per update
+    logger: DataLogger records / second from log() to written
+
+Usage:
+    python run_benchmarks.py [--quick] [--only parse,powers] [--out f.json]
+    python run_benchmarks.py --compare baseline.json [--threshold 0.2]
+'''
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from nicls.biosemi_listener import BioSemiListener
+from nicls.classifier import (Classifier, OnlineStatistics, _init_worker,
+                              _window_powers)
+from nicls.configuration import Config
+from nicls.linear_model import LinearModel
+from nicls.shared_window import SharedWindowPool
+
+from bench_parse import make_packet
+
+SAMPLERATE = 2048
+
+
+def time_calls(fn, repeats, warmup=1):
+    ''' Seconds taken by each of repeats calls of fn
+    '''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def summarize(case, params, times, items=1):
+    ''' Result record for a case, with durations in milliseconds and the
+    rate of items processed per second at the median
+    '''
+    times = np.asarray(times)
+    median = float(np.median(times))
+    return {"case": case,
+            "params": params,
+            "repeats": len(times),
+            "median_ms": round(median * 1e3, 4),
+            "p90_ms": round(float(np.percentile(times, 90)) * 1e3, 4),
+            "min_ms": round(float(times.min()) * 1e3, 4),
+            "per_second": round(items / median, 1) if median else None}
+
+
+def config_dict(freqs=8, **kwargs):
+    config = {"samplerate": SAMPLERATE, "freq_specs": [6, 180, freqs],
+              "wavelet_width": 5, "streamfilter": False,
+              "powerengine": "numpy"}
+    config.update(kwargs)
+    return config
+
+
+def bench_parse(quick):
+    repeats = 200 if quick else 2000
+    for channels, packets in itertools.product((32, 64, 128, 256), (1, 64)):
+        listener = BioSemiListener(None, None, channels)
+        data = make_packet(channels) * packets
+        yield summarize("parse", {"channels": channels, "packets": packets},
+                        time_calls(lambda: listener.parse(data), repeats),
+                        items=packets)
+
+
+def bench_powers(quick):
+    repeats = 3 if quick else 10
+    rng = np.random.default_rng(0)
+    # vary one dimension at a time around the default config. Windows
+    # shorter than 1 s do not leave room for the 6 Hz wavelet buffer.
+    grid = [(secs, 128, 8) for secs in (1.0, 1.5, 2.0)] + \
+           [(2.0, channels, 8) for channels in (32, 64, 256)] + \
+           [(2.0, 128, freqs) for freqs in (4, 16)]
+    for secs, channels, freqs in grid:
+        data = rng.standard_normal((int(secs * SAMPLERATE), channels))
+        config = config_dict(freqs)
+        yield summarize("powers",
+                        {"secs": secs, "channels": channels, "freqs": freqs},
+                        time_calls(lambda: Classifier.powers(data, config),
+                                   repeats))
+
+
+def bench_pool(quick):
+    repeats = 20 if quick else 100
+    channels = 128
+    for secs in (1.0, 2.0):
+        shape = (int(secs * SAMPLERATE), channels)
+        config = config_dict()
+        windows = SharedWindowPool(1, shape)
+        windows.array(0)[:] = np.random.default_rng(0).standard_normal(shape)
+        try:
+            with ProcessPoolExecutor(1, initializer=_init_worker,
+                                     initargs=(windows.initargs(), shape[0],
+                                               config)) as pool:
+                pool.submit(_window_powers, 0, config).result()
+                overheads = []
+                for _ in range(repeats):
+                    t = time.perf_counter()
+                    _, _, times = pool.submit(_window_powers, 0,
+                                              config).result()
+                    overheads.append(time.perf_counter() - t -
+                                     (times["powers"] - times["start"]))
+        finally:
+            windows.close()
+        yield summarize("pool", {"secs": secs, "channels": channels},
+                        overheads)
+
+
+def bench_predict(quick):
+    repeats = 200 if quick else 2000
+    rng = np.random.default_rng(0)
+    feats = 8 * 128
+    model = LinearModel(rng.standard_normal(feats), 0.1)
+    for epochs in (1, 64):
+        features = rng.standard_normal((epochs, feats))
+        yield summarize("predict", {"features": feats, "epochs": epochs},
+                        time_calls(lambda: model.probability(features),
+                                   repeats),
+                        items=epochs)
+
+
+def bench_statistics(quick):
+    repeats = 200 if quick else 2000
+    rng = np.random.default_rng(0)
+    # one vector per encoding epoch, and blocks folded in with one update
+    for feats, vectors in itertools.product((8 * 32, 8 * 128, 16 * 256),
+                                            (1, 64)):
+        block = rng.standard_normal((vectors, feats))
+        stats = OnlineStatistics(feats)
+        yield summarize("statistics", {"features": feats, "vectors": vectors},
+                        time_calls(lambda: stats.update(block), repeats),
+                        items=vectors)
+
+
+def bench_logger(quick):
+    # imported here since the logger reads Config when it is created
+    from nicls.data_logger import DataLogger, DataPoint
+
+    records = 20000 if quick else 200000
+    with tempfile.TemporaryDirectory() as datadir:
+        Config.load({"datadir": datadir,
+                     "logger": {"queuesize": records, "overflow": "block"}})
+        logger = DataLogger()
+        data = {"id": 1, "result": 0, "probability": 0.5}
+        t = time.perf_counter()
+        for _ in range(records):
+            logger.log(DataPoint("CLASSIFIER_RESULT", data=data))
+        queued = time.perf_counter() - t
+        logger.close()
+        written = time.perf_counter() - t
+        yield {"case": "logger",
+               "params": {"records": records},
+               "log_us": round(queued / records * 1e6, 3),
+               "per_second": round(records / written, 1),
+               "dropped": logger.dropped}
+
+
+CASES = {"parse": bench_parse,
+         "powers": bench_powers,
+         "pool": bench_pool,
+         "predict": bench_predict,
+         "statistics": bench_statistics,
+         "logger": bench_logger}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()}
+
+
+def key(result):
+    return result["case"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare(results, baseline, threshold):
+    ''' Print the change in rate against a baseline run.
+
+    :return: number of cases slower than the baseline by more than
+        threshold
+    '''
+    previous = {key(r): r for r in baseline["results"]}
+    regressions = 0
+    for result in results:
+        old = previous.get(key(result))
+        if not old or not old.get("per_second"):
+            continue
+        ratio = result["per_second"] / old["per_second"]
+        flag = ""
+        if ratio < 1 - threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(f"{result['case']:<10} {key(result)[1]:<45} "
+              f"{ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--only", help="comma separated cases to run, "
+                        f"from {', '.join(CASES)}")
+    parser.add_argument("--quick", action="store_true",
+                        help="fewer repeats, for a smoke test")
+    parser.add_argument("--out", help="write the results to this file "
+                        "instead of stdout")
+    parser.add_argument("--compare", help="results file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else list(CASES)
+    unknown = set(names) - set(CASES)
+    if unknown:
+        parser.error(f"unknown cases {', '.join(sorted(unknown))}")
+
+    results = list(itertools.chain.from_iterable(
+        CASES[name](args.quick) for name in names))
+    report = json.dumps({"environment": environment(), "results": results},
+                        indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(report + "\n")
+    elif not args.compare:
+        print(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(results, json.load(f), args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+''' Check the numpy power engine, nicls.spectral.PowerEngine, against
+the ptsa feature pipeline the classifier models were trained on.
+
+The recording is an EEGRecorder .bin file or a .npy file with shape
+(samples, channels). Every window of the configured length is run
+through both pipelines and the largest feature difference, in log10
+power, is compared with TOLERANCE. Run this on a real recording before
+setting "powerengine": "numpy" for a trained model.
+
+Usage: python validate_powers.py config.json recording [step_secs]
+'''
+import sys
+import time
+import numpy as np
+
+from nicls.configuration import load_configuration, Config
+from nicls.replay import load_session
+from nicls.spectral import PowerEngine, check_power_engine, ptsa_powers
+
+# log10 power units, 0.05 is a ~12% difference in power. The filters
+# differ slightly near the window edges (sosfiltfilt vs ba filtfilt
+# padding), which the wavelet buffer mostly removes.
+TOLERANCE = 0.05
+
+
+def main(config_path, recording, step_secs=0.25):
+    load_configuration(config_path)
+    samplerate = Config.classifier.samplerate
+    freq_specs = Config.classifier.freq_specs
+    width = Config.classifier.wavelet_width
+    n_samples = int(Config.classifier.secsdatabuffered * samplerate)
+    step = int(step_secs * samplerate)
+
+    check_power_engine("ptsa")
+    recorded_rate, data = load_session(recording)
+    if recorded_rate is not None and recorded_rate != samplerate:
+        raise ValueError(f"{recording} was recorded at {recorded_rate} Hz, "
+                         f"the config is {samplerate} Hz")
+    engine = PowerEngine(samplerate, n_samples, freq_specs, width)
+
+    worst = 0
+    # a constant offset per frequency means the wavelets are scaled
+    # differently, rather than differing near the edges
+    offset = np.zeros((len(engine.freqs), data.shape[1]))
+    reference_time = engine_time = 0
+    windows = range(0, data.shape[0] - n_samples + 1, step)
+    for start in windows:
+        window = np.asarray(data[start:start + n_samples], dtype=np.float64)
+        t = time.perf_counter()
+        expected = ptsa_powers(window, samplerate, freq_specs, width)
+        reference_time += time.perf_counter() - t
+        t = time.perf_counter()
+        actual = engine.powers(window)
+        engine_time += time.perf_counter() - t
+        worst = max(worst, np.abs(actual - expected).max())
+        offset += (actual - expected).reshape(offset.shape)
+
+    print(f"{len(windows)} windows, max feature difference {worst:.4g} "
+          f"(tolerance {TOLERANCE})")
+    for freq, diff in zip(engine.freqs, offset.mean(axis=1) / len(windows)):
+        print(f"  {freq:6.1f} Hz mean difference {diff:+.4g}")
+    print(f"ptsa {reference_time / len(windows) * 1e3:.1f} ms/window, "
+          f"engine {engine_time / len(windows) * 1e3:.1f} ms/window")
+    return worst <= TOLERANCE
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) < 2:
+        print(__doc__)
+        sys.exit(2)
+    sys.exit(0 if main(args[0], args[1], *map(float, args[2:3])) else 1)
@@ -0,0 +1,82 @@
+''' Compare features from the packet by packet StreamingFilter with the
+batch zero phase filters in PowerEngine, and the filtering cost per epoch.
+
+The recording is a .npy file with shape (samples, channels); without one
+a synthetic 1/f signal is used. Windows are only compared once WARMUP
+seconds have been streamed, so the highpass has settled.
+
+The streaming filter is causal, so components near the notch are
+delayed by its group delay and the window sees slightly different
+signal there. Frequencies next to 60 Hz differ the most on any single
+epoch; TOLERANCE applies to the mean absolute difference per feature.
+
+Usage: python validate_streaming_filter.py [recording.npy]
+'''
+import sys
+import time
+import numpy as np
+
+from nicls.ring_buffer import RingBuffer
+from nicls.spectral import PowerEngine, StreamingFilter
+
+SAMPLERATE = 2048
+PACKET = 16
+WINDOW = 4096
+EPOCH = SAMPLERATE // 4
+FREQ_SPECS = [6, 180, 8]
+WIDTH = 5
+WARMUP = 10
+# log10 power units, mean over epochs
+TOLERANCE = 0.1
+
+
+def synthetic(seconds=30, channels=32, seed=0):
+    rng = np.random.default_rng(seed)
+    n = seconds * SAMPLERATE
+    spectrum = np.fft.rfft(rng.standard_normal((channels, n)), axis=-1)
+    spectrum /= np.maximum(np.fft.rfftfreq(n, 1 / SAMPLERATE), 1) ** 0.5
+    return (np.fft.irfft(spectrum, n, axis=-1).T * 1e3 + 5e3)
+
+
+def main(data):
+    channels = data.shape[1]
+    engine = PowerEngine(SAMPLERATE, WINDOW, FREQ_SPECS, WIDTH)
+    stream = StreamingFilter(SAMPLERATE, channels)
+    raw = RingBuffer(WINDOW, channels)
+    filtered = RingBuffer(WINDOW, channels)
+
+    total, worst, epochs = 0, 0, 0
+    stream_time = batch_time = 0
+    for start in range(0, data.shape[0] - PACKET + 1, PACKET):
+        packet = data[start:start + PACKET]
+        t = time.perf_counter()
+        filtered.append(stream.filter(packet))
+        stream_time += time.perf_counter() - t
+        raw.append(packet)
+
+        end = start + PACKET
+        if end < WARMUP * SAMPLERATE or end % EPOCH:
+            continue
+        window = raw.snapshot()
+        t = time.perf_counter()
+        eeg = engine.filter(window.T)
+        batch_time += time.perf_counter() - t
+        expected = engine.log_powers(eeg)
+        actual = engine.powers(filtered.snapshot(), prefiltered=True)
+        diff = np.abs(actual.ravel() - expected.ravel())
+        total = total + diff
+        worst = max(worst, diff.max())
+        epochs += 1
+
+    seconds = data.shape[0] / SAMPLERATE
+    mean = (total / epochs).max()
+    print(f"{epochs} epochs, mean feature difference {mean:.4g} "
+          f"(tolerance {TOLERANCE}), largest single difference {worst:.4g}")
+    print(f"batch filter {batch_time / epochs * 1e3:.2f} ms/epoch, "
+          f"streaming filter {stream_time / seconds * 1e3 / 4:.2f} ms/epoch")
+    return mean <= TOLERANCE
+
+
+if __name__ == "__main__":
+    data = np.load(sys.argv[1]) if len(sys.argv) > 1 else synthetic()
+    sys.exit(0 if main(np.asarray(data, dtype=np.float64)) else 1)
@@ -1,57 +1,242 @@
 import asyncio
 import logging
+import time
 import numpy as np
 
+from nicls.data_logger import DataPoint, get_logger
+from nicls.latency import EpochTrace
 from nicls.pubsub import Publisher
-from functools import partial
 
 # samples / channel, width of bytes
 SAMPLES = 16
 WIDTH = 3
 
+
+def decode_samples(data, channels):
+    ''' Decode little endian, signed 24 bit samples into a
+    (samples, channels) int32 array. Any number of samples per
+    packet is supported, as long as the data holds whole samples
+    for every channel.
+
+    The raw triplets are copied once into the upper three bytes of
+    each int32, and an arithmetic right shift then sign extends
+    them, so no per sample Python work is done.
+
+    :param data: bytes-like object (bytes, bytearray, memoryview)
+    :param channels: number of channels interleaved in the data
+    :return: np.array with shape (samples, channels)
+    '''
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if raw.size % (WIDTH * channels):
+        raise ValueError(f"{raw.size} bytes is not a whole number of "
+                         f"{channels} channel samples")
+    n = raw.size // WIDTH
+    out = np.empty(n, dtype="<i4")
+    out.view(np.uint8).reshape(n, 4)[:, 1:] = raw.reshape(n, WIDTH)
+    out >>= 8
+    return out.reshape(-1, channels)
+
+
+class _PacketProtocol(asyncio.BufferedProtocol):
+    ''' Receives the biosemi stream straight into one preallocated
+    bytearray and hands all the whole packets of each read to the
+    listener at once, keeping a partial packet at the front of the buffer
+    until the rest arrives.
+    '''
+
+    def __init__(self, listener, packet_bytes, packets):
+        self.listener = listener
+        self.packet_bytes = packet_bytes
+        self._buffer = bytearray(packet_bytes * packets)
+        self._view = memoryview(self._buffer)
+        self.filled = 0
+        self.transport = None
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self._view[self.filled:]
+
+    def buffer_updated(self, nbytes):
+        read = time.monotonic()
+        self.filled += nbytes
+        end = self.filled - self.filled % self.packet_bytes
+        if end:
+            self.listener._packets_received(self._view[:end], read)
+        # move the partial packet to the front
+        self._buffer[:self.filled - end] = self._view[end:self.filled]
+        self.filled -= end
+        self.listener._check_backpressure(self.transport)
+
+    def eof_received(self):
+        return False  # close the transport
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+
 class BioSemiListener(Publisher):
-    def __init__(self, host, port, channels):
+    ''' Reads the biosemi TCP stream and publishes (samples, channels)
+    blocks.
+
+    Packets are assembled from whatever chunks the socket delivers. Each
+    read takes everything available, up to read_packets, and all the
+    whole packets in it are decoded together and published as one block,
+    so subscribers get a multiple of SAMPLES samples at a time and a
+    loop that fell behind catches up in a few large reads. If the
+    connection drops, the partial packet is discarded, so the stream
+    resyncs on a packet boundary when it reconnects, and reconnecting is
+    retried with exponential backoff up to MAX_RECONNECT_DELAY.
+
+    With a samplerate the stream is checked against the clock: a packet
+    arriving LATE_SECS later than it should is reported as late, and the
+    samples that should have arrived while disconnected are reported as
+    missing.
+    '''
+    RECONNECT_DELAY = 0.5
+    MAX_RECONNECT_DELAY = 10
+    LATE_SECS = 0.1
+
+    def __init__(self, host, port, channels, samplerate=None,
+                 read_packets=256):
         super().__init__("BIOSEMI")
         self.host = host
         self.port = port
         self.channels = channels
+        self.samplerate = samplerate
+        self.packet_bytes = channels * SAMPLES * WIDTH
+        self.read_packets = read_packets
+        self._protocol = None
+        self._stream_start = None
+        self._closing = False
+        self._paused = False
+
+        self.packets = 0
+        self.samples = 0
+        self.late_packets = 0
+        self.missing_samples = 0
+        self.partial_bytes = 0
+        self.reconnects = 0
 
     async def connect(self):
         logging.debug("attempting to connect biosemi")
-        self.reader, self.writer = await asyncio.open_connection(self.host,
-                                                                 self.port)
+        await self._open()
         logging.debug("connected to biosemi")
         asyncio.create_task(self.listen())  # Task not awaited
 
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        _, self._protocol = await loop.create_connection(
+            lambda: _PacketProtocol(self, self.packet_bytes,
+                                    self.read_packets),
+            self.host, self.port)
+        self._stream_start = time.monotonic()
+        self._stream_samples = 0
+
     async def listen(self):
-        ''' Read packets of data from the biosemi system and
-        publish them to the channel for object id.
+        ''' Keep the biosemi connection up until close is called,
+        reconnecting whenever it drops.
 
         :return: None
         '''
+        while not self._closing:
+            exc = await self._protocol.closed
+            if self._closing:
+                return
+            lost = time.monotonic()
+            if self._protocol.filled:
+                self.partial_bytes += self._protocol.filled
+                logging.warning(f"biosemi connection lost mid packet, "
+                                f"discarded {self._protocol.filled} bytes")
+            logging.warning(f"biosemi connection lost: {exc or 'closed'}")
+
+            delay = self.RECONNECT_DELAY
+            while not self._closing:
+                await asyncio.sleep(delay)
+                try:
+                    await self._open()
+                    break
+                except OSError as e:
+                    logging.warning(f"biosemi reconnect failed: {e}, "
+                                    f"retrying in {delay}s")
+                    delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+            else:
+                return
+
+            self.reconnects += 1
+            if self.samplerate:
+                missing = int((self._stream_start - lost) * self.samplerate)
+                self.missing_samples += missing
+                logging.warning(f"biosemi reconnected, about {missing} "
+                                "samples missed")
+            else:
+                logging.warning("biosemi reconnected")
+            get_logger().log(DataPoint("BIOSEMI_RECONNECTED",
+                                       data=self.metrics()))
+
+    def close(self):
+        self._closing = True
+        if self._protocol is not None:
+            self._protocol.transport.close()
+
+    def metrics(self):
+        return {"packets": self.packets,
+                "samples": self.samples,
+                "late packets": self.late_packets,
+                "missing samples": self.missing_samples,
+                "partial bytes": self.partial_bytes,
+                "reconnects": self.reconnects}
+
+    def _packets_received(self, data, read):
+        samples = self.parse(data)
+        trace = EpochTrace(read=read, parse=time.monotonic())
+        self.packets += len(data) // self.packet_bytes
+        self.samples += len(samples)
+        self._stream_samples += len(samples)
+        if self.samplerate:
+            self._check_continuity(read)
+        self.publish(samples, log_msg="biosemi data", no_log=True,
+                     trace=trace)
+
+    def _check_continuity(self, read):
+        ''' Compare the samples received since connecting with how many
+        the clock says should have been
+        '''
+        due = self._stream_start + self._stream_samples / self.samplerate
+        if read - due > self.LATE_SECS:
+            self.late_packets += 1
+            if self.late_packets == 1 or self.late_packets % 100 == 0:
+                logging.warning(f"biosemi packet {read - due:.3f}s late "
+                                f"({self.late_packets} late packets)")
+            # measure lateness from here on rather than reporting every
+            # packet after one stall
+            self._stream_start = read - self._stream_samples / self.samplerate
+
+    def _check_backpressure(self, transport):
+        ''' Stop reading the socket while a blocking subscriber queue is
+        full
+        '''
+        if self._paused or transport.is_closing() or not self.blocked():
+            return
+        self._paused = True
+        transport.pause_reading()
+        asyncio.create_task(self._resume(transport))  # Task not awaited
 
-        while not self.reader.at_eof():
-            # NOTE: this may need to handle incomplete packets
-            try:
-                data = await self.reader.readexactly(
-                    self.channels * SAMPLES * WIDTH
-                    )
-            except asyncio.IncompleteReadError as e:
-                # TODO
-                logging.warning(e)
-                print(e)
-            self.publish(self.parse(data), log_msg="biosemi data", no_log=True)
+    async def _resume(self, transport):
+        await self.backpressure()
+        self._paused = False
+        if not transport.is_closing():
+            transport.resume_reading()
 
     def parse(self, data: bytes):
-        ''' Data format is 24 bytes per channel, repeated 8 times,
-        so this function cuts this into a matrix with shape
-        (channels, samples).
+        ''' Data format is 24 bits per channel, repeated for every
+        sample in the packets, so this function cuts this into a matrix
+        with shape (samples, channels).
 
         :param data: little endian ordered data
-        :return: np.array with shape (channels, samples)
+        :return: np.array with shape (samples, channels)
         '''
-        # changed comprehension from generator to list because it was exhausted
-        # before being mapped. apparently poorly defined.
-        data = map(partial(int.from_bytes, byteorder="little", signed=True),
-                   [data[i:i + WIDTH] for i in range(0, len(data), WIDTH)])
-        return np.array(list(data)).reshape(SAMPLES, self.channels)
+        return decode_samples(data, self.channels)
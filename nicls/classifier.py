@@ -1,38 +1,66 @@
 import asyncio
+import atexit
 import multiprocessing
 import logging
 import time
 import numpy as np
 import json
-from sklearn.linear_model import LogisticRegression
-from ptsa.data.filters import ButterworthFilter, MorletWaveletFilter
-from ptsa.data.timeseries import TimeSeries
+import os
+import struct
+import zlib
 
-from collections import deque
 from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from nicls.data_logger import get_logger, Counter
+from nicls.latency import EpochTrace
+from nicls.linear_model import load_model
 from nicls.pubsub import Publisher, Subscriber
 from nicls.configuration import Config
+from nicls.ring_buffer import RingBuffer
+from nicls.scheduler import EpochScheduler
+from nicls.sequencer import ResultSequencer
+from nicls.shared_window import SharedWindowPool, attach_windows, worker_window
+from nicls.spectral import (IncrementalPowers, StreamingFilter,
+                            check_power_engine, get_engine, ptsa_powers)
 
 
 class Classifier(Publisher, Subscriber):
     _process_pool_executor = None
+    _shared_windows = None
     _cores = 1
 
     # The process pool is static so if we use more than one classifier
-    # then all the objects will share the same process pool
+    # then all the objects will share the same process pool. Setting it
+    # up again keeps the existing pool.
     @staticmethod
     def setup_process_pool(cores=1):
         if Classifier._process_pool_executor is None:
+            # EEG windows are handed to the workers through shared memory,
+            # two slots per worker: one being processed and one queued
+            window_shape = (int(Config.classifier.secsdatabuffered *
+                                Config.classifier.samplerate),
+                            Config.biosemi.channels)
+            Classifier._shared_windows = SharedWindowPool(2 * cores,
+                                                          window_shape)
+            atexit.register(Classifier._shared_windows.close)
             Classifier._process_pool_executor = ProcessPoolExecutor(
-                max_workers=cores)
+                max_workers=cores,
+                initializer=_init_worker,
+                initargs=(Classifier._shared_windows.initargs(),
+                          window_shape[0],
+                          Config.classifier.get_dict()))
             Classifier._cores = cores
-        else:
-            raise RuntimeError("Process pool already set up with "
-                               f"{Classifier._cores} workers")
+        elif cores != Classifier._cores:
+            logging.warning(f"Process pool already set up with "
+                            f"{Classifier._cores} workers, not {cores}")
 
     def __init__(self, biosemi_publisher_id, secs_of_data_buffered=None,
-                 samplerate=None, datarate=None, classiffreq=None):
+                 samplerate=None, datarate=None, classiffreq=None,
+                 warm_start=None):
+        '''
+        :param warm_start: start from the encoding statistics saved by an
+            earlier session, classifier.warmstart in the config by default
+        '''
         super().__init__("CLASSIFIER")
         logging.info("initializing classifier")
         self.samplerate = samplerate
@@ -49,130 +77,298 @@ class Classifier(Publisher, Subscriber):
         # features vector is shape (1, freqs x channels)
         self.num_feats = Config.classifier.freq_specs[2] * \
             Config.biosemi.channels
-        self._online_statistics = OnlineStatistics(self.num_feats)
-
-        # load classifier from json
-        self.model = ClassifierModel(
-            LogisticRegression()
-        ).load_json(Config.classifier.filepath).get()
-
-        # load classifier from json
-        self.model = ClassifierModel(
-            LogisticRegression()
-        ).load_json(Config.classifier.filepath).get()
-
-        # convert seconds to data packets
-        buffer_len = int(secs_of_data_buffered * (1 / datarate) * samplerate)
-        self.ring_buf = deque(maxlen=buffer_len)
+        self._online_statistics = OnlineStatistics(
+            self.num_feats, getattr(Config.classifier, "statshalflife", None))
+        # encoding epochs still being computed, and a count of resets so
+        # epochs from before a reset are not counted after it
+        self._encoding_tasks = set()
+        self._stats_generation = 0
+        # finalized statistics are saved, and a new session (or a restart
+        # mid-session) starts from them, blended with its own epochs. Only
+        # the statistics loaded here seed a block, so without a warm start
+        # every READ_ONLY_STATE starts from nothing.
+        self._collecting_stats = True
+        self._stats_file = getattr(Config.classifier, "statsfile", None) or \
+            statistics_path(Config.classifier.filepath)
+        self._saving_stats = asyncio.Lock()
+        self._prior_weight = getattr(Config.classifier, "statspriorweight",
+                                     1.0)
+        self._prior_statistics = None
+        if warm_start is None:
+            warm_start = getattr(Config.classifier, "warmstart", True)
+        if warm_start:
+            self._load_prior_statistics()
+
+        # load classifier weights from a model file or json, the model is
+        # scored in the process pool along with the powers
+        self.model = load_model(Config.classifier.filepath)
+        try:
+            self.model.check_layout(Config.classifier.freq_specs,
+                                    Config.biosemi.channels)
+        except ValueError as e:
+            raise RuntimeError(f"Classifier model {Config.classifier.filepath}"
+                               f" doesn't match the config: {e}") from e
+
+        # convert seconds to samples, buffer is (samples, channels)
+        buffer_len = int(secs_of_data_buffered * samplerate)
+        self.ring_buf = RingBuffer(buffer_len, Config.biosemi.channels)
+
+        # optionally filter packets once as they arrive, so the buffer
+        # holds filtered samples and epochs skip the batch filters
+        self._stream_filter = None
+        self._incremental = None
+        incremental = getattr(Config.classifier, "incrementalpowers", False)
+        stream_filter = getattr(Config.classifier, "streamfilter", False)
+        engine = getattr(Config.classifier, "powerengine", "ptsa")
+        try:
+            check_power_engine(engine)
+        except (ValueError, ImportError) as e:
+            raise RuntimeError(str(e)) from e
+        if (incremental or stream_filter) and engine != "numpy":
+            raise RuntimeError("streamfilter and incrementalpowers need "
+                               "\"powerengine\": \"numpy\"")
+        if incremental or stream_filter:
+            self._stream_filter = StreamingFilter(samplerate,
+                                                  Config.biosemi.channels)
+        # optionally keep running wavelet powers in this process, so an
+        # epoch only convolves the samples since the last one
+        if incremental:
+            self._incremental = IncrementalPowers(
+                samplerate, buffer_len, Config.classifier.freq_specs,
+                Config.classifier.wavelet_width, Config.biosemi.channels,
+                block=int(samplerate / classiffreq))
 
         # classiffreq is a frequency, i.e. classifications / second
-        # datarate is number of samples per tcp data packet
         # samplerate is samples / second
-        # need a conversion to packets per classification:
-        # packets / classification =
-        #       (packets/sample)*(samples/s)*(s/classification)
-        self.npackets = int((1 / datarate) * samplerate *
-                            (1 / classiffreq) * (1 / Classifier._cores))
-        self.packet_count = 0  # track how many packets have arrived
+        # so an epoch is cut every samplerate / classiffreq samples, with
+        # at most one epoch per worker being classified at a time
+        self.scheduler = EpochScheduler(
+            self._start_epoch,
+            samplerate / classiffreq,
+            getattr(Config.classifier, "maxinflight", Classifier._cores),
+            getattr(Config.classifier, "schedulerpolicy", "coalesce"))
         self.data_id = 0  # track an id to match biosemi data to classifier
-
-        # Subscribe to data source(s))
+        # end sample and future of the raw features of the newest epoch,
+        # and whether an encoding epoch used them. An epoch cut from the
+        # same samples reuses them. With encodingshare, an encoding epoch
+        # also reuses them if they were cut at most that many seconds
+        # earlier, trading an earlier window for one less computation.
+        self._recent_features = None
+        self._encoding_share = int(samplerate * getattr(
+            Config.classifier, "encodingshare", 0))
+        self.features_shared = 0
+        self._last_trace = None  # timestamps of the newest packet
+        self._traces = {}  # data_id -> EpochTrace of epochs in flight
+        # results can finish out of order, this decides which are sent
+        self.sequencer = ResultSequencer(
+            self._publish_result,
+            getattr(Config.classifier, "resultpolicy", "ordered"),
+            getattr(Config.classifier, "resultdeadline", None),
+            self._result_dropped)
+
+        # Subscribe to data source(s)), optionally through a queue so a
+        # slow receive doesn't hold up the reads
         self.subscribe(self.biosemi_receiver,
-                       biosemi_publisher_id, name_in_log="Classifier")
+                       biosemi_publisher_id, name_in_log="Classifier",
+                       maxlen=getattr(Config.classifier, "queuelen", None),
+                       policy=getattr(Config.classifier, "queuepolicy",
+                                      "block"))
 
     def biosemi_receiver(self, message, **kwargs):
         # TODO: check this is data and not 'error' or some such
+        if self._stream_filter is not None:
+            message = self._stream_filter.filter(message)
         self.ring_buf.append(message)
+        if self._incremental is not None:
+            self._incremental.append(message)
+        self._last_trace = kwargs.get("trace")
+        if self._last_trace is not None:
+            self._last_trace.mark("append")
 
         # Only run stats or fit if we have a full buffer
-        if len(self.ring_buf) < self.ring_buf.maxlen:
+        if not self._window_ready():
             logging.warning(
                 "Not enough biosemi data collected yet, please wait.")
             return
             
-        if self._encoding and self._encoding_stats == None:
+        if self._encoding and self._collecting_stats:
            # only process one epoch per word presentation
            self._encoding = False
-           data = self.ring_buf.copy()
-           asyncio.create_task(self.encoding_stats(data))
-        elif self._enabled:
-            # Skip npackets to avoid launching too many processes
-            self.packet_count += 1
-            if (self.packet_count % self.npackets == 0):
-                data = self.ring_buf.copy()
-                self.data_id += 1
-                logging.info("EEG_EPOCH_END")
-                self.publish({"EEG_EPOCH_END":{"id":self.data_id, "eeg collection duration":self.secs_of_data_buffered}}, log=True)
-                asyncio.create_task(self.fit(data, self.data_id))  # Task not awaited
-
-    def powers(self, data, config: dict, norm: tuple = (0, 1)):
+           task = asyncio.create_task(
+               self.encoding_stats(
+                   self._epoch_features(encoding=True),
+                   self._stats_generation))
+           self._encoding_tasks.add(task)
+           task.add_done_callback(self._encoding_tasks.discard)
+        if self._enabled:
+            self.scheduler.advance(len(message))
+
+    def _start_epoch(self):
+        # the epoch's latency starts with its newest packet
+        trace = EpochTrace(**(self._last_trace.times if self._last_trace
+                              else {}))
+        trace.mark("epoch")
+        norm = self._normalization()
+        features = self._epoch_features(norm, trace, self.model)
+        self.data_id += 1
+        self._traces[self.data_id] = trace
+        logging.info("EEG_EPOCH_END")
+        self.publish({"EEG_EPOCH_END":{"id":self.data_id, "eeg collection duration":self.secs_of_data_buffered}}, log=True)
+        self.sequencer.epoch_started(self.data_id)
+        task = asyncio.create_task(self.fit(features, self.data_id, norm, trace))  # Task not awaited
+        task.add_done_callback(partial(self._epoch_done, self.data_id))
+
+    def _epoch_done(self, data_id, task):
+        self.scheduler.done()
+        if task.cancelled() or task.exception() is not None:
+            logging.error(f"Classification of epoch {data_id} failed: "
+                          f"{'cancelled' if task.cancelled() else repr(task.exception())}")
+            self.sequencer.cancel(data_id)
+            self._traces.pop(data_id, None)
+
+    def _publish_result(self, result):
+        # the trace is finished by whoever sends the result on
+        self.publish({"CLASSIFIER_RESULT": result}, log=True,
+                     trace=self._traces.pop(result["id"], None))
+
+    def _result_dropped(self, data_id):
+        # the result is never sent, so its trace has no end to record
+        self._traces.pop(data_id, None)
+
+    def _window_ready(self):
+        if self._incremental is not None:
+            return self._incremental.is_ready()
+        return self.ring_buf.is_full()
+
+    def _epoch_features(self, norm: tuple = (0, 1), trace=None, model=None,
+                        encoding=False):
+        ''' Start computing the raw features of the current window, or
+        reuse those of the newest epoch: always if it was cut from the
+        same samples, and for an encoding epoch if it was cut at most
+        encodingshare seconds earlier. An encoding epoch never reuses
+        features another encoding epoch counted already.
+
+        :return: future of (raw powers, probability or None). Only the
+            epoch that started the computation gets a probability, for its
+            norm and model.
+        '''
+        end = self.ring_buf.total_samples
+        if self._recent_features is not None:
+            recent_end, recent, encoded = self._recent_features
+            failed = recent.done() and (recent.cancelled() or
+                                        recent.exception() is not None)
+            share = self._encoding_share if encoding else 0
+            if end - recent_end <= share and not failed and \
+                    not (encoding and encoded):
+                logging.debug(f"Sharing the features of the epoch ending "
+                              f"at sample {recent_end}, {end - recent_end} "
+                              "samples back")
+                self.features_shared += 1
+                self._recent_features = (recent_end, recent,
+                                         encoded or encoding)
+                return asyncio.ensure_future(self._shared_features(recent))
+        features = asyncio.ensure_future(
+            self._powers(self._epoch_window(), norm, trace, model))
+        self._recent_features = (end, features, encoding)
+        return features
+
+    @staticmethod
+    async def _shared_features(features):
+        powers, _ = await features
+        return powers, None
+
+    def _epoch_window(self):
+        ''' What an epoch task needs to compute its powers: the raw log
+        powers in incremental mode, otherwise a copy of the window
+        '''
+        if self._incremental is not None:
+            return self._incremental.log_powers().reshape((1, -1))
+        return self._copy_window()
+
+    def _copy_window(self):
+        ''' Copy the buffered window for the process pool.
+
+        :return: index of the shared memory slot holding the window, or
+            the window itself if no slot is free
+        '''
+        windows = Classifier._shared_windows
+        if windows is not None and windows.shape == self.ring_buf.shape:
+            slot = windows.acquire()
+            if slot is not None:
+                self.ring_buf.snapshot(out=windows.array(slot))
+                return slot
+            logging.warning("No free shared window slot, pickling window")
+        return self.ring_buf.snapshot()
+
+    @staticmethod
+    def _release_window(window):
+        if not isinstance(window, np.ndarray):
+            Classifier._shared_windows.release(window)
+
+    @staticmethod
+    def powers(data, config: dict, norm: tuple = (0, 1)):
         """
         Process an incoming eeg buffer and compute PSD
         Parameters:
-        data - eeg buffer
+        data - eeg buffer with shape samples x channels
         config - dict with parameters for wavelet analysis
         norm - tuple of array-like with (mean, std) for normalizing
             each feature
         Returns:
         norm_pows - normalized powers with shape 1 x n_feats
         """
-        # the loading here should construct the full processing chain,
-        # which will run as part of fit
-        # stack data along first axis (samples)
-        # then, transpose to make array channels x samples
-
-        data = np.vstack(data).T
-        eeg = TimeSeries(data,
-                         coords={'samplerate': self.samplerate},
-                         dims=['channel', 'time']
-                         )
-        # average reference
-        eeg = eeg - eeg.mean("channel")
-        # filter out line noise
-        eeg = ButterworthFilter(eeg, filt_type='stop', freq_range=[
-                                58, 62], order=4).filter()
-        # highpass filter 0.5 Hz to ignore drift
-        eeg = ButterworthFilter(eeg, filt_type='highpass',
-                                freq_range=0.5).filter()
-        # Wavelet power decomposition
-        # FIXME: what's the right number of cpus?
-        freq_specs = config['freq_specs']
-        freqs = np.logspace(np.log10(freq_specs[0]),
-                            np.log10(freq_specs[1]),
-                            freq_specs[2])
-        # width is really n_cycles, buffer needs to be at least half
-        # the width at the lowest frequency
-        buffer_time = 1 / freq_specs[0] * config['wavelet_width'] / 2
-        pows = MorletWaveletFilter(eeg,
-                                   freqs=freqs,
-                                   width=config['wavelet_width'],
-                                   output='power',
-                                   cpus=5).filter()
-        pows = pows.remove_buffer(buffer_time).data + \
-            np.finfo(np.float).eps / 2.
-        # log transform
-        log_pows = np.log10(pows)
-        # average over time/samples
-        avg_pows = np.nanmean(log_pows, -1)
-        # reshape as events x features (only one event epoch)
-        avg_pows = avg_pows.reshape((1, -1))
-        # normalize powers
-        norm_pows = (avg_pows - norm[0]) / norm[1]
-        return norm_pows
-
-    async def encoding_stats(self, data):
-        t = time.time()
-        logging.info("calculating encoding stats")
+        if config.get('powerengine', 'ptsa') == 'ptsa':
+            return ptsa_powers(data, config['samplerate'],
+                               config['freq_specs'], config['wavelet_width'],
+                               norm)
+        # the filter coefficients and wavelets are cached per process
+        # (see _init_worker), so this only runs the filters and convolution
+        engine = get_engine(config['samplerate'], len(data),
+                            config['freq_specs'], config['wavelet_width'])
+        return engine.powers(data, norm,
+                             prefiltered=config.get('streamfilter', False))
+
+    async def _powers(self, window, norm: tuple = (0, 1), trace=None,
+                      model=None):
+        ''' Raw powers for an epoch from _epoch_window, and the model's
+        probability for the normalized powers if a model is given
+
+        :return: tuple of (powers, probability or None)
+        '''
+        trace = trace or EpochTrace()
+        trace.mark("submit")
+        if self._incremental is not None:
+            trace.mark("start")
+            trace.mark("powers")
+            prob = None
+            if model is not None:
+                prob = float(model.probability((window - norm[0]) /
+                                               norm[1])[0])
+                trace.mark("predict")
+            return window, prob
 
         loop = asyncio.get_running_loop()  # JPB: TODO: Catch exception?
         # pass in configuration parameters for analysis
         classifier_config = Config.classifier.get_dict()
-        # TODO: pass in normalization params
-        powers = await loop.run_in_executor(
-            Classifier._process_pool_executor, self.powers, np.array(
-                list(data)), classifier_config
-        )
-        # .update() expects a column vectors of feature powers
+        try:
+            powers, prob, times = await loop.run_in_executor(
+                Classifier._process_pool_executor, _window_powers, window,
+                classifier_config, norm, model
+            )
+        finally:
+            Classifier._release_window(window)
+        for stage, t in times.items():
+            trace.mark(stage, t)
+        return powers, prob
+
+    async def encoding_stats(self, features, generation=None):
+        t = time.time()
+        logging.info("calculating encoding stats")
+
+        powers, _ = await features
+        if generation is not None and generation != self._stats_generation:
+            logging.info("Dropping encoding epoch from before the stats reset")
+            return
         logging.info("Updating online stats")
         self._online_statistics.update(powers)
 
@@ -181,35 +377,50 @@ class Classifier(Publisher, Subscriber):
     # TODO: Want to pass in to fit something that will help track
     # the original order, so that classifier results can be matched
     # with the epochs they're classifying
-    async def fit(self, data, data_id):
+    async def fit(self, features, data_id, norm: tuple = (0, 1), trace=None):
         t = time.time()
         logging.info("fitting data")
 
-        if not self._encoding_stats:
-            logging.warning("Classifier fitting without normalization")
-            stats = (0, 1)
-        else: # Use sample std, not population std (ddof = 1)
-            stats = (self._encoding_stats[0], self._encoding_stats[2])
-
-        loop = asyncio.get_running_loop()  # JPB: TODO: Catch exception?
-        # pass in configuration parameters for analysis
-        classifier_config = Config.classifier.get_dict()
-        powers = await loop.run_in_executor(
-            Classifier._process_pool_executor, self.powers, np.array(
-                list(data)), classifier_config, stats
-        )
-        # why predict(powers)[0]? Just to have the right data type, it's size 1 anyway
-        prob = self.model.predict_proba(powers)[0, 1]
+        trace = trace or EpochTrace()
+        powers, prob = await features
+        if prob is None:
+            # features shared with an earlier epoch, score them here
+            trace.mark("powers")
+            prob = float(self.model.probability((powers - norm[0]) /
+                                                norm[1])[0])
+            trace.mark("predict")
         result = int(bool(prob > 0.5))
         classificationDuration = time.time() - t
         print(f"classification took {classificationDuration} seconds")
-        self.publish({"CLASSIFIER_RESULT":{"id":data_id, "result":result, "probability":prob, "normalized":str(self._encoding_stats != None), "classifier duration":classificationDuration}}, log=True)
+        self.sequencer.result(data_id, {"id":data_id, "result":result, "probability":prob, "normalized":str(self._encoding_stats != None), "classifier duration":classificationDuration})
+
+    def _normalization(self):
+        if self._encoding_stats: # Use sample std, not population std (ddof = 1)
+            return (self._encoding_stats[0], self._encoding_stats[2])
+        elif self.model.mean is not None:
+            logging.info("Classifier fitting with the model's normalization")
+            return (self.model.mean, self.model.std)
+        logging.warning("Classifier fitting without normalization")
+        return (0, 1)
+
+    def stats(self):
+        ''' Epochs started and dropped by the scheduler and results sent
+        and dropped by the sequencer, counted since the classifier started
+        '''
+        return {"epochs": {"launched": self.scheduler.launched,
+                           "dropped": self.scheduler.dropped,
+                           "in flight": self.scheduler.in_flight,
+                           "backlog": self.scheduler.backlog,
+                           "features shared": self.features_shared},
+                "results": {"delivered": self.sequencer.delivered,
+                            "dropped": self.sequencer.dropped}}
 
     def enable(self):
         self._enabled = True
 
     def disable(self):
         self._enabled = False
+        self.scheduler.reset()
 
     def encoding(self, enabled):
         print('--------------------')
@@ -222,12 +433,105 @@ class Classifier(Publisher, Subscriber):
         print('READ_ONLY_STATE: ' + str(enabled))
         print('--------------------')
         if enabled:
-            self._online_statistics.reset()
-            self._encoding_stats = None
+            self._stats_generation += 1
+            self._collecting_stats = True
+            self._online_statistics.reset(self._prior_statistics,
+                                          self._prior_weight)
+            # keep normalizing with the saved statistics meanwhile
+            self._encoding_stats = self._prior_statistics.finalize() \
+                if self._prior_statistics else None
         else:
+            asyncio.create_task(self._finalize_encoding_stats())  # Task not awaited
+
+    async def _finalize_encoding_stats(self):
+        ''' Finalize the encoding stats once every encoding epoch already
+        started has been counted
+        '''
+        generation = self._stats_generation
+        pending = list(self._encoding_tasks)
+        if pending:
+            logging.info(f"Waiting for {len(pending)} encoding epochs "
+                         "before finalizing stats")
+            await asyncio.gather(*pending, return_exceptions=True)
+        if generation != self._stats_generation:
+            return  # reset while waiting
+        try:
             self._encoding_stats = self._online_statistics.finalize()
-            logging.info("_encoding_stats have been finalized")
-            logging.info(f"mean:{self._encoding_stats[0]}, p-std: {self._encoding_stats[1]}, s-std: {self._encoding_stats[2]}")
+        except RuntimeError as e:
+            logging.error(f"Encoding stats not finalized: {e}")
+            return
+        self._collecting_stats = False
+        logging.info("_encoding_stats have been finalized")
+        logging.info(f"mean:{self._encoding_stats[0]}, p-std: {self._encoding_stats[1]}, s-std: {self._encoding_stats[2]}")
+        saved = self._online_statistics.copy()
+        # the file is synced to disk, which is kept off the event loop.
+        # The lock keeps a slow save from replacing a newer one.
+        async with self._saving_stats:
+            try:
+                await asyncio.to_thread(saved.save, self._stats_file)
+            except OSError as e:
+                logging.error(f"Encoding stats not saved to "
+                              f"{self._stats_file}: {e}")
+                return
+        logging.info(f"Encoding stats of {saved.count:g} epochs saved to "
+                     f"{self._stats_file}")
+
+    def _load_prior_statistics(self):
+        ''' Start from the statistics saved by an earlier session, if
+        there are any for this feature layout
+        '''
+        if not os.path.exists(self._stats_file):
+            logging.info(f"No saved encoding stats at {self._stats_file}")
+            return
+        try:
+            prior = OnlineStatistics.load(self._stats_file,
+                                          self._online_statistics.halflife)
+            if prior.num_feats != self.num_feats:
+                raise ValueError(f"saved for {prior.num_feats} features, "
+                                 f"not {self.num_feats}")
+            encoding_stats = prior.finalize()
+        except (OSError, ValueError, RuntimeError) as e:
+            logging.warning(f"Ignoring saved encoding stats "
+                            f"{self._stats_file}: {e}")
+            return
+        self._prior_statistics = prior
+        self._online_statistics.reset(prior, self._prior_weight)
+        self._encoding_stats = encoding_stats
+        logging.info(f"Warm start from the encoding stats of {prior.count:g} "
+                     f"epochs in {self._stats_file}")
+
+def _init_worker(window_args, n_samples, config: dict):
+    ''' Process pool initializer. Maps the shared windows and builds the
+    filters and wavelet kernels of the numpy power engine for the
+    configured window length once, so they stay resident for every epoch
+    this worker processes.
+    '''
+    attach_windows(*window_args)
+    if config.get('powerengine', 'ptsa') == 'numpy':
+        get_engine(config['samplerate'], n_samples,
+                   config['freq_specs'], config['wavelet_width'])
+
+
+def _window_powers(window, config: dict, norm: tuple = (0, 1), model=None):
+    ''' Process pool entry point for Classifier.powers, scoring the powers
+    normalized with norm with model if one is given. window is either a
+    shared memory slot index or the data itself.
+
+    :return: tuple of (raw powers, probability or None, times) with times
+        a dict of the monotonic "start", "powers" and "predict" times in
+        the worker
+    '''
+    times = {"start": time.monotonic()}
+    if not isinstance(window, np.ndarray):
+        window = worker_window(window)
+    powers = Classifier.powers(window, config)
+    times["powers"] = time.monotonic()
+    prob = None
+    if model is not None:
+        prob = float(model.probability((powers - norm[0]) / norm[1])[0])
+        times["predict"] = time.monotonic()
+    return powers, prob, times
+
 
 # Lightweight wrapper class for saving and loading sklearn models
 # as json
@@ -257,41 +561,185 @@ class ClassifierModel:
         return self.model
 
 
+# Saved OnlineStatistics are a STATS_HEADER_SIZE byte header followed by
+# the mean and M2 as little endian float64 arrays of (features,)
+# magic, version, features, count, sum of squared weights, crc32 of the
+# arrays
+STATS_HEADER = struct.Struct("<8sIIddI")
+STATS_HEADER_SIZE = 64
+STATS_MAGIC = b"NICLSSTA"
+STATS_VERSION = 1
+STATS_SUFFIX = ".nstats"
+
+
+def statistics_path(model_path):
+    ''' Where the encoding statistics for a classifier model are saved:
+    the data directory, named after the model file. Models are trained
+    per subject, so one subject's statistics are never loaded for
+    another.
+    '''
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(Config.datadir, name + STATS_SUFFIX)
+
+
 class OnlineStatistics:
-    def __init__(self, num_feats):
-        self._existingAggregate = (0,
-                                   np.zeros((1, num_feats)),
-                                   np.zeros((1, num_feats)))
-        print("\n\n\nINIT\n\n\n")
-
-    def reset(self):
-        (count, mean, M2) = self._existingAggregate
-        self._existingAggregate = (0,
-                                   np.zeros((1, mean.size)),
-                                   np.zeros((1, M2.size)))
-        print("\n\n\nRESET\n\n\n")
-
-    # For a new features vector newFeats, compute the new count, new mean, the new M2.
-    # mean accumulates the mean of the entire dataset
-    # M2 aggregates the squared distance from the mean
-    # count aggregates the number of samples seen so far
+    ''' Running mean and variance of feature vectors, with float64
+    accumulators.
+
+    update folds in any number of vectors at once with Chan's parallel
+    form of Welford's algorithm, and merge folds in another aggregate, so
+    partial statistics kept elsewhere can be combined.
+
+    With a halflife (in vectors) the statistics are exponentially
+    weighted instead, so older vectors count for less. Weighted vectors
+    are folded in one at a time, and weighted aggregates can't be merged.
+
+    The aggregate can be saved and loaded, and reset can start from a
+    saved aggregate, so statistics carry over between sessions.
+    '''
+
+    def __init__(self, num_feats, halflife=None):
+        self.num_feats = num_feats
+        self.halflife = halflife
+        self._decay = 0.5 ** (1 / halflife) if halflife else None
+        self.reset()
+
+    def reset(self, prior=None, weight=1.0):
+        ''' Start over, or from the vectors counted in prior.
+
+        :param prior: OnlineStatistics to start from
+        :param weight: scales the weight of every vector in prior, so
+            below 1 they count for less than new vectors. The mean and
+            variance of prior are unchanged.
+        '''
+        if prior is None:
+            # count is the sum of the weights, all 1 without a halflife
+            self.count = 0.0
+            self._sum_sq_weights = 0.0
+            self.mean = np.zeros((1, self.num_feats))
+            self.M2 = np.zeros((1, self.num_feats))
+            return
+        if prior.num_feats != self.num_feats:
+            raise ValueError(f"Can't start statistics of {self.num_feats} "
+                             f"features from {prior.num_feats}")
+        self.count = prior.count * weight
+        self._sum_sq_weights = prior._sum_sq_weights * weight ** 2
+        self.mean = prior.mean.copy()
+        self.M2 = prior.M2 * weight
+
+    def copy(self):
+        statistics = OnlineStatistics(self.num_feats, self.halflife)
+        statistics.reset(self)
+        return statistics
+
+    @property
+    def aggregate(self):
+        return (self.count, self.mean, self.M2)
+
     def update(self, newFeats):
-        (count, mean, M2) = self._existingAggregate
-        count += 1
-        delta = newFeats - mean
-        mean += delta / count
-        delta2 = newFeats - mean
-        M2 += delta * delta2
-        self._existingAggregate = (count, mean, M2)
-        print("\n\n\nUPDATE {}\n\n\n".format(count))
-
-    # Retrieve the mean, std dev and sample std dev from an aggregate
+        ''' Add feature vectors.
+
+        :param newFeats: array with shape (feats,) or (vectors, feats)
+        '''
+        feats = np.asarray(newFeats, dtype=np.float64).reshape(
+            -1, self.num_feats)
+        if not len(feats):
+            return
+        if self._decay is not None:
+            for x in feats:
+                self._update_weighted(x)
+            return
+        n = len(feats)
+        mean = feats.mean(axis=0, keepdims=True)
+        M2 = ((feats - mean) ** 2).sum(axis=0, keepdims=True)
+        self._combine(n, mean, M2, n)
+
+    def merge(self, other):
+        ''' Add the vectors counted in another OnlineStatistics
+        '''
+        if self._decay is not None or other._decay is not None:
+            raise ValueError("Exponentially weighted statistics can't be "
+                             "merged")
+        if other.num_feats != self.num_feats:
+            raise ValueError(f"Can't merge statistics of {other.num_feats} "
+                             f"features into {self.num_feats}")
+        if other.count:
+            self._combine(other.count, other.mean, other.M2,
+                          other._sum_sq_weights)
+        return self
+
+    def _combine(self, count, mean, M2, sum_sq_weights):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.M2 = self.M2 + M2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+        self._sum_sq_weights += sum_sq_weights
+
+    def _update_weighted(self, x):
+        # West's weighted update, after decaying every earlier weight
+        self.count = self.count * self._decay + 1
+        self._sum_sq_weights = self._sum_sq_weights * self._decay ** 2 + 1
+        self.M2 *= self._decay
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.count
+        self.M2 += delta * (x - self.mean)
+
     def finalize(self):
-        (count, mean, M2) = self._existingAggregate
-        print("\n\n\nFINALIZE {}\n\n\n".format(count))
-        if count < 2:
-            print(count)  
-            raise RuntimeError("Variable count is less than 2. This may mean that the updates need more time to process first. (add lock?)")
-        else:
-            (mean, variance, sampleVariance) = (mean, M2 / count, M2 / (count - 1))
-            return (mean, np.sqrt(variance), np.sqrt(sampleVariance))
+        ''' Retrieve the mean, std dev and sample std dev. The sample
+        variance uses the effective number of vectors when weighted.
+        '''
+        if self.count < 2:
+            raise RuntimeError("Fewer than 2 feature vectors counted "
+                               f"({self.count:g}), can't estimate variance")
+        variance = self.M2 / self.count
+        sampleVariance = self.M2 / (self.count -
+                                    self._sum_sq_weights / self.count)
+        return (self.mean.copy(), np.sqrt(variance), np.sqrt(sampleVariance))
+
+    def save(self, filepath):
+        ''' Write the aggregate to a file. The file is replaced in one
+        step, so a crash never leaves part of one.
+        '''
+        data = np.concatenate([self.mean.reshape(-1),
+                               self.M2.reshape(-1)]).astype("<f8")
+        header = STATS_HEADER.pack(STATS_MAGIC, STATS_VERSION, self.num_feats,
+                                   self.count, self._sum_sq_weights,
+                                   zlib.crc32(data))
+        directory = os.path.dirname(os.path.abspath(filepath))
+        os.makedirs(directory, exist_ok=True)
+        temp = filepath + ".tmp"
+        with open(temp, 'wb') as file:
+            file.write(header.ljust(STATS_HEADER_SIZE, b"\0"))
+            file.write(data.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, filepath)
+
+    @classmethod
+    def load(cls, filepath, halflife=None):
+        ''' Read an aggregate written by save
+
+        :param halflife: halflife of the loaded statistics' updates
+        '''
+        with open(filepath, 'rb') as file:
+            raw = file.read()
+        if len(raw) < STATS_HEADER_SIZE:
+            raise ValueError(f"{filepath} is truncated")
+        magic, version, num_feats, count, sum_sq_weights, crc = \
+            STATS_HEADER.unpack_from(raw)
+        if magic != STATS_MAGIC:
+            raise ValueError(f"{filepath} is not a NICLS statistics file")
+        if version != STATS_VERSION:
+            raise ValueError(f"Unsupported statistics file version {version}")
+        data = np.frombuffer(raw, dtype="<f8", offset=STATS_HEADER_SIZE)
+        if data.size != 2 * num_feats:
+            raise ValueError(f"{filepath} is truncated")
+        if zlib.crc32(data) != crc:
+            raise ValueError(f"{filepath} is corrupt, checksum mismatch")
+        statistics = cls(num_feats, halflife)
+        statistics.count = count
+        statistics._sum_sq_weights = sum_sq_weights
+        statistics.mean = data[:num_feats].astype(np.float64).reshape(1, -1)
+        statistics.M2 = data[num_feats:].astype(np.float64).reshape(1, -1)
+        return statistics
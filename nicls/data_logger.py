@@ -2,12 +2,13 @@ import datetime
 import time
 import json
 from nicls.configuration import Config
-from multiprocessing import Queue, Value
-import asyncio
-import aiofiles
+from multiprocessing import Value
 from typing import Union
+import atexit
 import os
 import logging
+import queue
+import threading
 
 _logger = None
 
@@ -70,10 +71,39 @@ class DataPoint:
 
 
 class DataLogger:
+    ''' Writes DataPoints to a JSON lines file from a dedicated thread.
+
+    log() only queues the DataPoint. The writer thread drains the queue in
+    batches, serializes each batch into one buffer and appends it to a
+    file that stays open, so logging never waits on the disk.
+
+    The queue is bounded by logger.queuesize, and logger.overflow decides
+    what happens when it is full:
+        "drop_oldest": the oldest queued DataPoint is dropped
+        "drop_newest": the new DataPoint is dropped
+        "block": log() waits up to BLOCK_TIMEOUT for room, then drops
+    '''
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+    BLOCK_TIMEOUT = 1.0
+
     def __init__(self):
-        # use multiprocessing Queue so that
-        # classifier can run in separate process
-        self.data_queue = Queue()
+        settings = Config.logger if hasattr(Config, "logger") else None
+        self.maxsize = getattr(settings, "queuesize", 100000)
+        self.overflow = getattr(settings, "overflow", "drop_oldest")
+        self.batchsize = getattr(settings, "batchsize", 1000)
+        self.flushinterval = getattr(settings, "flushinterval", 1.0)
+        if self.overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown logger overflow policy {self.overflow}, "
+                             f"expected one of {self.OVERFLOW_POLICIES}")
+
+        # the writer thread is the only consumer
+        self.data_queue = queue.Queue(maxsize=self.maxsize)
+        self.records_written = 0
+        self.bytes_written = 0
+        self.dropped = 0
+        # records the writer thread couldn't serialize or write, only
+        # counted by the writer thread
+        self.failed = 0
 
         # auto create with timestamp
         timestr = time.strftime("%Y%m%d%H%M")
@@ -82,24 +112,116 @@ class DataLogger:
         self.filename = os.path.join(Config.datadir, timestr + ".jsonl")
         logging.debug(f"data will be written to {self.filename}")
 
-    def __del__(self):
-        # flush the queue
-        self._write()
+        self._file = open(self.filename, mode='a', encoding='utf-8')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="DataLogger",
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
 
     def log(self, message: Union[DataPoint, dict]):
-        logging.debug("entered logging function")
         if isinstance(message, DataPoint):
             data = message
         elif isinstance(message, dict):
-            logging.debug("Message is not DataPoint")
             data = DataPoint(**message)
         else:
             raise Exception("Message format not supported")
 
-        self.data_queue.put(data)
+        try:
+            if self.overflow == "block":
+                self.data_queue.put(data, timeout=self.BLOCK_TIMEOUT)
+            else:
+                self.data_queue.put_nowait(data)
+            return
+        except queue.Full:
+            pass
+
+        if self.overflow == "drop_oldest":
+            try:
+                self.data_queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.data_queue.put_nowait(data)
+            except queue.Full:
+                pass
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logging.warning(f"Data logger queue full, {self.dropped} "
+                            "DataPoints dropped")
+
+    def metrics(self):
+        return {
+            "queue depth": self.data_queue.qsize(),
+            "records written": self.records_written,
+            "bytes written": self.bytes_written,
+            "dropped": self.dropped + self.failed,
+            "failed": self.failed,
+        }
 
     async def write(self):
-        async with aiofiles.open(self.filename, mode='a+') as f:
-            while not self.data_queue.empty():
-                await f.write(str(self.data_queue.get_nowait()))
-
+        ''' Log the writer metrics. Writing itself happens on the writer
+        thread; this is meant to be run with repeated_invoke.
+        '''
+        self.log(DataPoint("LOGGER_STATS", data=self.metrics()))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._write_batch(self._next_batch(self.flushinterval))
+        # drain whatever is left before closing
+        while not self.data_queue.empty():
+            self._write_batch(self._next_batch(0))
+
+    def _next_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self.data_queue.get(timeout=timeout) if timeout
+                         else self.data_queue.get_nowait())
+            while len(batch) < self.batchsize:
+                batch.append(self.data_queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        # one line per record, some DataPoints already end in a newline.
+        # A record that can't be serialized is dropped on its own, so it
+        # never stops the writer thread.
+        lines = []
+        for dp in batch:
+            try:
+                lines.append(str(dp).rstrip("\n") + "\n")
+            except Exception as e:
+                self.failed += 1
+                if self.failed == 1 or self.failed % 1000 == 0:
+                    logging.error(f"Data logger dropped a "
+                                  f"{getattr(dp, 'type', type(dp).__name__)}"
+                                  f" DataPoint that can't be serialized: "
+                                  f"{e!r} ({self.failed} failed)")
+        if not lines:
+            return
+        buffer = "".join(lines)
+        try:
+            self._file.write(buffer)
+            self._file.flush()
+        except OSError as e:
+            # at most once a batch, and the next batch tries again
+            self.failed += len(lines)
+            logging.error(f"Data logger dropped {len(lines)} DataPoints, "
+                          f"writing {self.filename} failed: {e} "
+                          f"({self.failed} failed)")
+            return
+        self.records_written += len(lines)
+        # json.dumps escapes non ascii, so characters are bytes
+        self.bytes_written += len(buffer)
+
+    def close(self):
+        ''' Write everything still queued and close the file
+        '''
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self._file.close()
@@ -0,0 +1,138 @@
+import atexit
+import logging
+import os
+import struct
+import time
+import numpy as np
+
+from nicls.configuration import Config
+from nicls.pubsub import Subscriber
+
+# magic, version, channels, samplerate, dtype, samples written
+HEADER = struct.Struct("<8sIId8sQ")
+HEADER_SIZE = 64
+MAGIC = b"NICLSEEG"
+VERSION = 1
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER.size)
+    magic, version, channels, samplerate, dtype, samples = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a NICLS EEG recording")
+    if version != VERSION:
+        raise ValueError(f"Unsupported EEG recording version {version}")
+    return {"channels": channels,
+            "samplerate": samplerate,
+            "dtype": np.dtype(dtype.rstrip(b"\0").decode()),
+            "samples": samples}
+
+
+def load_recording(path):
+    ''' Map a recording made by EEGRecorder.
+
+    :return: tuple of (header dict, read only np.memmap with shape
+        (samples, channels))
+    '''
+    header = read_header(path)
+    data = np.memmap(path, dtype=header["dtype"], mode='r',
+                     offset=HEADER_SIZE,
+                     shape=(header["samples"], header["channels"]))
+    return header, data
+
+
+class EEGRecorder(Subscriber):
+    ''' Appends every biosemi packet to a binary file.
+
+    The file is a HEADER_SIZE byte header followed by (samples, channels)
+    samples, and is grown CHUNK_SECS at a time and written through a
+    memory map, so a packet costs one copy into the map. A sidecar text
+    file with the same name plus ".times" holds one "sample index, unix
+    time" line per packet, for lining the samples up with the event log.
+    '''
+    CHUNK_SECS = 60
+
+    def __init__(self, biosemi_publisher_id, channels, samplerate,
+                 dtype="int32", filename=None):
+        self.channels = channels
+        self.samplerate = samplerate
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+
+        if filename is None:
+            timestr = time.strftime("%Y%m%d%H%M")
+            if not os.path.exists(Config.datadir):
+                os.makedirs(Config.datadir)
+            base = os.path.join(Config.datadir, timestr)
+            filename = base + "_eeg.bin"
+            n = 1
+            while os.path.exists(filename):
+                filename = f"{base}_{n}_eeg.bin"
+                n += 1
+        self.filename = filename
+        logging.debug(f"raw eeg will be written to {self.filename}")
+
+        self._chunk = int(self.CHUNK_SECS * samplerate)
+        # exclusive create, an existing recording is never truncated
+        self._file = open(self.filename, 'x+b')
+        try:
+            self._times = open(self.filename + ".times", 'x')
+        except OSError:
+            self._file.close()
+            os.remove(self.filename)
+            raise
+        self._capacity = 0
+        self._map = None
+        self.samples = 0
+        self._header_samples = 0
+        self._write_header()
+        self._grow(self._chunk)
+        atexit.register(self.close)
+
+        self.subscribe(self.biosemi_receiver, biosemi_publisher_id,
+                       name_in_log="EEGRecorder")
+
+    def _write_header(self):
+        self._header_samples = self.samples
+        header = HEADER.pack(MAGIC, VERSION, self.channels,
+                             float(self.samplerate),
+                             self.dtype.str.encode(), self.samples)
+        self._file.seek(0)
+        self._file.write(header.ljust(HEADER_SIZE, b"\0"))
+        self._file.flush()
+
+    def _grow(self, samples):
+        self._capacity += samples
+        self._file.truncate(HEADER_SIZE + self._capacity * self.channels *
+                            self.dtype.itemsize)
+        self._map = np.memmap(self._file, dtype=self.dtype, mode='r+',
+                              offset=HEADER_SIZE,
+                              shape=(self._capacity, self.channels))
+        self._write_header()
+
+    def biosemi_receiver(self, message, **kwargs):
+        n = len(message)
+        if self.samples + n > self._capacity:
+            self._grow(max(self._chunk, n))
+        self._map[self.samples:self.samples + n] = message
+        self._times.write(f"{self.samples},{time.time()}\n")
+        self.samples += n
+        # keep the sample count on disk about a second behind, so the
+        # recording is readable even if we are never closed
+        if self.samples - self._header_samples >= self.samplerate:
+            self._write_header()
+
+    def close(self):
+        ''' Trim the preallocated space and write the final header
+        '''
+        if self._file.closed:
+            return
+        atexit.unregister(self.close)
+        self._map.flush()
+        self._map = None
+        self._file.truncate(HEADER_SIZE + self.samples * self.channels *
+                            self.dtype.itemsize)
+        self._write_header()
+        self._file.close()
+        self._times.close()
+        logging.info(f"recorded {self.samples} samples to {self.filename}")
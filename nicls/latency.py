@@ -0,0 +1,155 @@
+import logging
+import time
+import numpy as np
+
+from nicls.data_logger import DataPoint, get_logger
+
+_latency_stats = None
+
+# stages of the closed loop, in order. Each histogram measures the time
+# from the previous stage to the named one; "total" is read to sent.
+#   read: packet read from the biosemi socket
+#   parse: packet decoded
+#   append: packet filtered and appended to the classifier buffer
+#   epoch: epoch cut from the buffer
+#   submit: epoch handed to the process pool
+#   start: worker started on the epoch
+#   powers: features computed
+#   predict: classifier probability computed, in the worker
+#   sent: result back on the loop, written and drained to the task
+STAGES = ("read", "parse", "append", "epoch", "submit", "start", "powers",
+          "predict", "sent")
+
+
+def get_latency_stats():
+    global _latency_stats
+
+    if _latency_stats is None:
+        _latency_stats = LatencyStats()
+
+    return _latency_stats
+
+
+class LatencyHistogram:
+    ''' HDR style histogram of durations with microsecond resolution.
+
+    Values below 2 * SUB_BUCKETS us are counted exactly. Above that every
+    power of two range is split into SUB_BUCKETS buckets, so any recorded
+    value is known to within 1 / SUB_BUCKETS of itself, for a fixed
+    memory cost up to MAX_SECONDS.
+    '''
+    SUB_BUCKETS = 64
+    MAX_SECONDS = 3600
+
+    def __init__(self):
+        top = int(self.MAX_SECONDS * 1e6)
+        self._counts = np.zeros(self._index(top) + 1, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        self._counts[:] = 0
+        self.count = 0
+        self._total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, us):
+        shift = max(0, us.bit_length() - self.SUB_BUCKETS.bit_length())
+        return (shift * self.SUB_BUCKETS) + (us >> shift)
+
+    def _value(self, index):
+        ''' Lowest value in us counted in a bucket
+        '''
+        shift = max(0, index // self.SUB_BUCKETS - 1)
+        return (index - shift * self.SUB_BUCKETS) << shift
+
+    def record(self, seconds):
+        us = min(max(0, int(seconds * 1e6)), int(self.MAX_SECONDS * 1e6))
+        self._counts[self._index(us)] += 1
+        self.count += 1
+        self._total += us
+        self.min = us if self.min is None else min(self.min, us)
+        self.max = us if self.max is None else max(self.max, us)
+
+    def percentile(self, q):
+        ''' Duration in seconds that q percent of recorded values are at
+        or below, to the histogram precision
+        '''
+        if not self.count:
+            return None
+        rank = max(1, int(np.ceil(q / 100 * self.count)))
+        index = int(np.searchsorted(np.cumsum(self._counts), rank))
+        return min(self._value(index), self.max) / 1e6
+
+    def summary(self):
+        ''' Count and durations in milliseconds
+        '''
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": round(self._total / self.count / 1e3, 3),
+            "min": self.min / 1e3,
+            "p50": round(self.percentile(50) * 1e3, 3),
+            "p90": round(self.percentile(90) * 1e3, 3),
+            "p99": round(self.percentile(99) * 1e3, 3),
+            "max": self.max / 1e3,
+        }
+
+
+class EpochTrace:
+    ''' Monotonic timestamps of one epoch as it moves through STAGES
+    '''
+
+    def __init__(self, **times):
+        self.times = dict(times)
+
+    def mark(self, stage, t=None):
+        self.times[stage] = time.monotonic() if t is None else t
+
+    def durations(self):
+        ''' Seconds between consecutive stages that were both marked,
+        keyed by the later stage, plus "total"
+        '''
+        out = {}
+        marked = [s for s in STAGES if s in self.times]
+        for prev, stage in zip(marked, marked[1:]):
+            out[stage] = self.times[stage] - self.times[prev]
+        if len(marked) > 1:
+            out["total"] = self.times[marked[-1]] - self.times[marked[0]]
+        return out
+
+
+class LatencyStats:
+    ''' Latency histograms for every stage of the closed loop
+    '''
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, stage, seconds):
+        if stage not in self.histograms:
+            self.histograms[stage] = LatencyHistogram()
+        self.histograms[stage].record(seconds)
+
+    def record_trace(self, trace: EpochTrace):
+        for stage, seconds in trace.durations().items():
+            self.record(stage, seconds)
+
+    def summary(self):
+        return {stage: hist.summary()
+                for stage, hist in self.histograms.items()}
+
+    def reset(self):
+        for hist in self.histograms.values():
+            hist.reset()
+
+    async def log(self):
+        ''' Write the current summary to the data log. Meant to be run
+        with repeated_invoke.
+        '''
+        summary = self.summary()
+        if not summary:
+            return
+        logging.info(f"latency (ms): {summary}")
+        get_logger().log(DataPoint("LATENCY_STATS", data=summary))
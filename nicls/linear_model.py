@@ -0,0 +1,226 @@
+''' Linear classifier inference and its binary model file.
+
+A model file is a HEADER_SIZE byte header followed by little endian
+float64 arrays, each 8 byte aligned:
+    coef: (features,)
+    classes: (2,)
+    freqs: (frequencies,) wavelet frequencies of the features
+    mean, std: (features,) normalization, only if the header says so
+Features are frequency major, as PowerEngine.powers makes them. The
+header holds a crc32 of everything after it.
+
+Convert a model saved with ClassifierModel.save_json:
+
+    python -m nicls.linear_model model.json model.nmodel --config config.json
+'''
+import argparse
+import json
+import struct
+import zlib
+import numpy as np
+
+from scipy.special import expit
+from nicls.spectral import frequencies
+
+# magic, version, model type, features, channels, frequencies, flags,
+# intercept, crc32 of the arrays
+HEADER = struct.Struct("<8sI16sIIIIdI")
+HEADER_SIZE = 64
+MAGIC = b"NICLSMDL"
+VERSION = 1
+MODEL_TYPE = b"logistic"
+HAS_NORMALIZATION = 1
+
+
+def load_model(filepath):
+    ''' Load a LinearModel from a model file or a ClassifierModel json
+    '''
+    with open(filepath, 'rb') as file:
+        magic = file.read(len(MAGIC))
+    if magic == MAGIC:
+        return LinearModel.from_file(filepath)
+    return LinearModel.from_json(filepath)
+
+
+class LinearModel:
+    ''' Inference for a trained binary logistic regression.
+
+    The weights are pulled out of the model once into contiguous float64
+    arrays, so scoring is a dot product and a sigmoid, without sklearn's
+    input validation, and any number of epochs can be scored in one call.
+    It is small enough to send to the process pool with every epoch, so
+    the probability is computed in the worker along with the powers.
+    '''
+
+    def __init__(self, coef, intercept=0.0, classes=(0, 1), freqs=None,
+                 channels=None, mean=None, std=None):
+        '''
+        :param coef: weights with shape (features,) or (1, features)
+        :param intercept: bias added to the weighted sum
+        :param classes: labels of the negative and positive class
+        :param freqs: wavelet frequencies the model was trained on
+        :param channels: channels the model was trained on
+        :param mean: training feature means, for normalizing
+        :param std: training feature standard deviations
+        '''
+        coef = np.asarray(coef, dtype=np.float64)
+        if coef.ndim == 2 and coef.shape[0] != 1:
+            raise ValueError("Only binary models are supported, got "
+                             f"coefficients for {coef.shape[0]} classes")
+        self.coef = np.ascontiguousarray(coef.reshape(-1))
+        self.intercept = float(np.asarray(intercept).reshape(-1)[0])
+        self.classes = np.asarray(classes)
+        self.freqs = None if freqs is None else np.asarray(freqs,
+                                                           dtype=np.float64)
+        self.channels = channels
+        self.mean = mean
+        self.std = std
+
+    @classmethod
+    def from_sklearn(cls, model):
+        return cls(model.coef_, model.intercept_, model.classes_)
+
+    @classmethod
+    def from_json(cls, filepath):
+        ''' Load a model saved with ClassifierModel.save_json
+        '''
+        with open(filepath, 'r') as file:
+            params = json.load(file)
+        return cls(params["coef_"], params["intercept_"],
+                   params.get("classes_", (0, 1)))
+
+    @classmethod
+    def from_file(cls, filepath, verify=True):
+        ''' Map a model file written by save.
+
+        :param verify: check the crc32 of the arrays
+        '''
+        with open(filepath, 'rb') as file:
+            raw = file.read(HEADER.size)
+        (magic, version, model_type, features, channels, nfreqs, flags,
+         intercept, crc) = HEADER.unpack(raw)
+        if magic != MAGIC:
+            raise ValueError(f"{filepath} is not a NICLS model file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported model file version {version}")
+        if model_type.rstrip(b"\0") != MODEL_TYPE:
+            raise ValueError(f"Unsupported model type {model_type}")
+
+        data = np.memmap(filepath, dtype="<f8", mode='r', offset=HEADER_SIZE)
+        if verify and zlib.crc32(data) != crc:
+            raise ValueError(f"{filepath} is corrupt, checksum mismatch")
+        sizes = [features, 2, nfreqs]
+        if flags & HAS_NORMALIZATION:
+            sizes += [features, features]
+        if data.size != sum(sizes):
+            raise ValueError(f"{filepath} is truncated")
+        arrays = np.split(data, np.cumsum(sizes)[:-1])
+        coef, classes, freqs = arrays[:3]
+        mean, std = arrays[3:] if flags & HAS_NORMALIZATION else (None, None)
+        return cls(coef, intercept, classes, freqs, channels, mean, std)
+
+    def save(self, filepath):
+        if self.freqs is None or self.channels is None:
+            raise ValueError("The feature layout, freqs and channels, is "
+                             "needed to save a model file")
+        self.check_layout(len(self.freqs), self.channels)
+        arrays = [self.coef, np.asarray(self.classes, dtype=np.float64),
+                  self.freqs]
+        flags = 0
+        if self.mean is not None:
+            arrays += [self.mean, self.std]
+            flags |= HAS_NORMALIZATION
+        data = np.concatenate([np.asarray(a, dtype="<f8").reshape(-1)
+                               for a in arrays])
+        header = HEADER.pack(MAGIC, VERSION, MODEL_TYPE, self.n_features,
+                             self.channels, len(self.freqs), flags,
+                             self.intercept, zlib.crc32(data))
+        with open(filepath, 'wb') as file:
+            file.write(header.ljust(HEADER_SIZE, b"\0"))
+            file.write(data.tobytes())
+
+    @property
+    def n_features(self):
+        return self.coef.size
+
+    def check_layout(self, freq_specs, channels):
+        ''' Raise ValueError unless the model takes the features made for
+        freq_specs and channels.
+
+        :param freq_specs: [low, high, count] as in the config, or just
+            the number of frequencies
+        '''
+        count = freq_specs if np.isscalar(freq_specs) else freq_specs[2]
+        if self.n_features != count * channels:
+            raise ValueError(f"Model has {self.n_features} features, "
+                             f"{count} frequencies x {channels} channels "
+                             f"is {count * channels}")
+        if self.channels is not None and self.channels != channels:
+            raise ValueError(f"Model was trained on {self.channels} "
+                             f"channels, not {channels}")
+        if self.freqs is not None and not np.isscalar(freq_specs) and \
+                not np.allclose(self.freqs, frequencies(freq_specs)):
+            raise ValueError(f"Model was trained on frequencies "
+                             f"{np.round(self.freqs, 2).tolist()}, not "
+                             f"{np.round(frequencies(freq_specs), 2).tolist()}")
+
+    def decision_function(self, features):
+        '''
+        :param features: array with shape (epochs, features)
+        :return: array with shape (epochs,)
+        '''
+        features = np.asarray(features, dtype=np.float64)
+        if features.shape[-1] != self.coef.size:
+            raise ValueError(f"Expected {self.coef.size} features, "
+                             f"got {features.shape[-1]}")
+        return features @ self.coef + self.intercept
+
+    def probability(self, features):
+        ''' Probability of the positive class for every epoch
+        '''
+        return expit(self.decision_function(features))
+
+    def predict_proba(self, features):
+        ''' Same output as sklearn's predict_proba, (epochs, 2)
+        '''
+        prob = self.probability(features)
+        return np.stack([1 - prob, prob], axis=-1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert a ClassifierModel json to a model file")
+    parser.add_argument("json", help="model saved with save_json")
+    parser.add_argument("out", help="model file to write")
+    parser.add_argument("--config", help="NICLS config to take the feature "
+                        "layout from")
+    parser.add_argument("--freq-specs", type=float, nargs=3,
+                        metavar=("LOW", "HIGH", "COUNT"))
+    parser.add_argument("--channels", type=int)
+    parser.add_argument("--normalization", help=".npz with mean and std "
+                        "arrays of the training features")
+    args = parser.parse_args(argv)
+
+    freq_specs, channels = args.freq_specs, args.channels
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        freq_specs = freq_specs or config["classifier"]["freq_specs"]
+        channels = channels or config["biosemi"]["channels"]
+    if freq_specs is None or channels is None:
+        parser.error("give --config or both --freq-specs and --channels")
+    freq_specs = [freq_specs[0], freq_specs[1], int(freq_specs[2])]
+
+    model = LinearModel.from_json(args.json)
+    model.freqs = frequencies(freq_specs)
+    model.channels = channels
+    if args.normalization:
+        norm = np.load(args.normalization)
+        model.mean, model.std = norm["mean"], norm["std"]
+    model.check_layout(freq_specs, channels)
+    model.save(args.out)
+    print(f"wrote {model.n_features} feature model to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from nicls.data_logger import DataPoint, get_logger
+from nicls.latency import LatencyHistogram
+
+
+def use_event_loop(name="asyncio"):
+    ''' Select the event loop implementation before the loop is created.
+
+    :param name: "asyncio" for the standard loop or "uvloop". uvloop is
+        an optional dependency, without it the standard loop is kept.
+    '''
+    if name == "asyncio":
+        return
+    if name != "uvloop":
+        raise ValueError(f"Unknown event loop {name}, "
+                         "expected asyncio or uvloop")
+    try:
+        import uvloop
+    except ImportError:
+        logging.warning("uvloop is not installed, using the asyncio loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def _describe(handle):
+    ''' Readable name of the callback behind an event loop handle
+    '''
+    callback = getattr(handle, "_callback", None)
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        return f"{owner.get_name()} {owner.get_coro().__qualname__}"
+    return repr(handle)[:200]
+
+
+class LoopMonitor:
+    ''' Watches how long the event loop takes to get back to a callback.
+
+    Every interval seconds the monitor sleeps and measures how much later
+    than asked it woke up, which is how late every other callback, socket
+    read and result send was at that moment too. Lags over threshold are
+    counted as stalls.
+
+    With time_callbacks, every callback on the standard asyncio loop is
+    also timed, and the slowest ones over threshold are kept until the
+    next log, so stalls can be traced to the code that caused them. This
+    wraps asyncio's Handle._run for the whole process until stop_timing,
+    so it is meant for tracking a problem down, not for every session.
+    uvloop callbacks can't be timed.
+    '''
+    SLOWEST = 10
+
+    def __init__(self, interval=0.1, threshold=0.05, time_callbacks=False):
+        '''
+        :param interval: seconds between lag measurements
+        :param threshold: seconds of lag, or of a single callback, that
+            is reported
+        :param time_callbacks: time every callback while run is running
+        '''
+        self.interval = interval
+        self.threshold = threshold
+        self.time_callbacks = time_callbacks
+        self.lag = LatencyHistogram()
+        self.stalls = 0
+        self.slow_callbacks = 0
+        self._slowest = []  # heap of (seconds, order, description)
+        self._untimed_run = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        if self.time_callbacks:
+            self.start_timing(loop)
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = max(0, loop.time() - expected)
+                self.lag.record(lag)
+                if lag > self.threshold:
+                    self.stalls += 1
+        finally:
+            self.stop_timing()
+
+    def start_timing(self, loop):
+        ''' Time every callback of the standard asyncio loop
+        '''
+        if not isinstance(loop, asyncio.BaseEventLoop):
+            logging.info("event loop callbacks can't be timed on "
+                         f"{type(loop).__name__}, only measuring lag")
+            return
+        if self._untimed_run is not None:
+            return
+        run = asyncio.events.Handle._run
+        monitor = self
+
+        def timed_run(handle):
+            start = time.perf_counter()
+            run(handle)
+            took = time.perf_counter() - start
+            if took > monitor.threshold:
+                monitor._slow(handle, took)
+
+        self._untimed_run = run
+        asyncio.events.Handle._run = timed_run
+
+    def stop_timing(self):
+        ''' Put back the callback runner start_timing replaced
+        '''
+        if self._untimed_run is None:
+            return
+        asyncio.events.Handle._run = self._untimed_run
+        self._untimed_run = None
+
+    def _slow(self, handle, took):
+        self.slow_callbacks += 1
+        description = _describe(handle)
+        logging.warning(f"event loop blocked for {took * 1e3:.1f} ms by "
+                        f"{description}")
+        entry = (took, self.slow_callbacks, description)
+        if len(self._slowest) < self.SLOWEST:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    def summary(self):
+        ''' Lag in milliseconds, stall counts and the slowest callbacks
+        since the last log
+        '''
+        summary = {"lag": self.lag.summary(), "stalls": self.stalls}
+        if self.time_callbacks:
+            summary["slow callbacks"] = self.slow_callbacks
+            summary["slowest"] = [{"ms": round(took * 1e3, 3),
+                                   "callback": name}
+                                  for took, _, name in sorted(self._slowest,
+                                                              reverse=True)]
+        return summary
+
+    def reset(self):
+        self.lag.reset()
+        self.stalls = 0
+        self.slow_callbacks = 0
+        self._slowest = []
+
+    async def log(self):
+        ''' Write the summary to the data log and start counting again.
+        Meant to be run with repeated_invoke.
+        '''
+        summary = self.summary()
+        self.reset()
+        logging.info(f"event loop: {summary}")
+        get_logger().log(DataPoint("LOOP_STATS", data=summary))
@@ -3,6 +3,9 @@ import logging
 
 from nicls.configuration import load_configuration, Config
 from nicls.data_logger import get_logger, log_file_path
+from nicls.latency import get_latency_stats
+from nicls.loop_monitor import LoopMonitor, use_event_loop
+from nicls.pubsub import log_queue_stats
 from nicls.utils import repeated_invoke
 from nicls.task_server import TaskServer
 
@@ -19,12 +22,29 @@ async def main():
     # set up logger
     logger = get_logger()
     logging.info("Data logger initialized")
-    logger_write = repeated_invoke(logger.write, 5)
+    # periodic records of the logger and subscriber queues and of where
+    # the closed loop time goes
+    stats_interval = getattr(Config.system, "statsinterval", 60)
+    logger_write = repeated_invoke(logger.write, stats_interval)
+    latency_log = repeated_invoke(get_latency_stats().log, stats_interval)
+    queue_log = repeated_invoke(log_queue_stats, stats_interval)
+    tasks = [logger_write, latency_log, queue_log]
+    # event loop stalls delay every socket read and result send
+    if getattr(Config.system, "loopmonitor", True):
+        monitor = LoopMonitor(
+            threshold=getattr(Config.system, "slowcallback", 0.05),
+            time_callbacks=getattr(Config.system, "timecallbacks", False))
+        tasks += [monitor.run(), repeated_invoke(monitor.log, stats_interval)]
 
-    async with TaskServer(Config.task.host, Config.task.port) as task_server:
-        await asyncio.gather(task_server, logger_write)
+    server = TaskServer(Config.task.host, Config.task.port)
+    # epochs the classifier dropped for being behind, and results dropped
+    # by the result policy
+    tasks.append(repeated_invoke(server.session.log_stats, stats_interval))
+    async with server as task_server:
+        await asyncio.gather(task_server, *tasks)
     
 if __name__ == "__main__":
     # load config
     load_configuration("../config.json")
+    use_event_loop(getattr(Config.system, "eventloop", "asyncio"))
     asyncio.run(main())
@@ -1,17 +1,163 @@
+import asyncio
 import logging
 import inspect
+import time
+import weakref
 
-from django.dispatch import Signal
+from collections import deque
+from nicls.data_logger import DataPoint, get_logger
 from uuid import uuid4
 from os import path
 
 
-_dispatcher = Signal()
+# publisher id -> subscriptions, in the order they subscribed
+_subscriptions = {}
+
 
 def _caller_function_info():
     prev_frame = inspect.currentframe().f_back.f_back.f_code
     return path.basename(prev_frame.co_filename), prev_frame.co_name
 
+
+def _debug_enabled():
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+class _Subscription:
+    ''' One handler subscribed to one publisher.
+
+    Handlers are held by weak reference, like django signals did, so a
+    subscriber that goes away stops receiving without unsubscribing.
+    Coroutine function handlers are run as tasks.
+
+    With a maxlen, messages are queued and handed to the handler by a task
+    of its own, so a slow handler never holds up the publisher. When
+    maxlen messages are already queued the policy decides what happens:
+        "drop_oldest": the oldest queued message is dropped
+        "drop_newest": the new message is dropped
+        "block": the message is queued anyway and the publisher waits in
+            Publisher.backpressure until there is room. A publisher that
+            never awaits backpressure lets the queue grow.
+    '''
+    POLICIES = ("drop_oldest", "drop_newest", "block")
+
+    def __init__(self, handler, name, maxlen=None, policy="drop_oldest"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, "
+                             f"expected one of {self.POLICIES}")
+        if inspect.ismethod(handler):
+            self._ref = weakref.WeakMethod(handler)
+        else:
+            self._ref = weakref.ref(handler)
+        self.name = name
+        self.is_async = asyncio.iscoroutinefunction(handler)
+        self.maxlen = maxlen or None
+        self.policy = policy
+        # (monotonic time queued, kwargs)
+        self.queue = deque() if self.maxlen else None
+        self._ready = None
+        self._room = None
+        self._task = None
+
+        self.delivered = 0
+        self.dropped = 0
+        self._lag_total = 0
+        self.max_lag = 0
+
+    @property
+    def handler(self):
+        return self._ref()
+
+    @property
+    def full(self):
+        return self.queue is not None and len(self.queue) >= self.maxlen
+
+    def deliver(self, handler, kwargs):
+        if self.queue is None:
+            result = handler(**kwargs)
+            if self.is_async:
+                asyncio.create_task(result)  # Task not awaited
+            return
+
+        if self.full and self.policy != "block":
+            self._drop()
+            if self.policy == "drop_newest":
+                return
+            self.queue.popleft()
+        self.queue.append((time.monotonic(), kwargs))
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._room = asyncio.Event()
+            self._task = asyncio.create_task(self._drain())
+        self._ready.set()
+
+    async def wait_for_room(self):
+        while self.full:
+            self._room.clear()
+            await self._room.wait()
+
+    def stats(self):
+        ''' Queue depth, delivery counts and the time messages spent
+        queued, in milliseconds
+        '''
+        return {"queued": len(self.queue),
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "mean lag": round(self._lag_total / self.delivered * 1e3, 3)
+                if self.delivered else None,
+                "max lag": round(self.max_lag * 1e3, 3)}
+
+    def _drop(self):
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logging.warning(f"{self.name} queue full, {self.dropped} "
+                            "messages dropped")
+
+    async def _drain(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self.queue:
+                queued, kwargs = self.queue.popleft()
+                self._room.set()
+                handler = self.handler
+                if handler is None:
+                    return
+                lag = time.monotonic() - queued
+                self._lag_total += lag
+                self.max_lag = max(self.max_lag, lag)
+                self.delivered += 1
+                try:
+                    result = handler(**kwargs)
+                    if self.is_async:
+                        await result
+                except Exception:
+                    logging.exception(f"{self.name} failed handling a "
+                                      "message")
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+def queue_stats():
+    ''' Stats of every queued subscription, keyed by subscriber name and
+    publisher id
+    '''
+    return {f"{s.name} <- {publisher_id}": s.stats()
+            for publisher_id, subscriptions in _subscriptions.items()
+            for s in subscriptions if s.queue is not None}
+
+
+async def log_queue_stats():
+    ''' Write the queue stats to the data log. Meant to be run with
+    repeated_invoke.
+    '''
+    stats = queue_stats()
+    if stats:
+        get_logger().log(DataPoint("QUEUE_STATS", data=stats))
+
+
 class Publisher:
     def __init__(self, publisher_id=None):
         if publisher_id:
@@ -20,14 +166,65 @@ class Publisher:
             self.publisher_id = str(uuid4().hex)
 
     def publish(self, message, log_msg=None, no_log=None, **kwargs):
-        if not no_log:
+        if not no_log and _debug_enabled():
             logging.debug("({}:{}) {} published {}".format(
                 *_caller_function_info(), self.publisher_id, log_msg or message))
-        _dispatcher.send(sender=self.publisher_id, message=message, **kwargs)
+
+        subscriptions = _subscriptions.get(self.publisher_id)
+        if not subscriptions:
+            return
+        kwargs["sender"] = self.publisher_id
+        kwargs["message"] = message
+        for subscription in list(subscriptions):
+            handler = subscription.handler
+            if handler is None:
+                subscription.close()
+                subscriptions.remove(subscription)
+            else:
+                subscription.deliver(handler, kwargs)
+
+    def blocked(self):
+        ''' True while a subscriber queue with the "block" policy is full
+        '''
+        return any(s.policy == "block" and s.full
+                   for s in _subscriptions.get(self.publisher_id, ()))
+
+    async def backpressure(self):
+        ''' Wait until every subscriber queue with the "block" policy has
+        room. Publishers that can wait, such as a socket reader, await
+        this after publishing so a slow subscriber slows the reads
+        instead of growing its queue.
+        '''
+        for subscription in _subscriptions.get(self.publisher_id, ()):
+            if subscription.policy == "block" and subscription.full:
+                await subscription.wait_for_room()
+
 
 class Subscriber:
-    def subscribe(self, handler, publisher_id, name_in_log=None):
-        logging.debug("({}:{}) {} subscribed to {}".format(
-            *_caller_function_info(), name_in_log or _caller_function_info()[0], publisher_id))
-        _dispatcher.connect(handler, sender=publisher_id)
+    def subscribe(self, handler, publisher_id, name_in_log=None,
+                  maxlen=None, policy="drop_oldest"):
+        '''
+        :param handler: function or coroutine function called with the
+            message and any keyword arguments it was published with
+        :param publisher_id: publisher to receive messages from
+        :param name_in_log: name of the subscriber in logs
+        :param maxlen: if given, messages are queued for the handler and
+            delivered from its own task
+        :param policy: what to do with a message once maxlen are queued,
+            "drop_oldest", "drop_newest" or "block"
+        '''
+        name = name_in_log or _caller_function_info()[0]
+        if _debug_enabled():
+            logging.debug("({}:{}) {} subscribed to {}".format(
+                *_caller_function_info(), name, publisher_id))
+        subscriptions = _subscriptions.setdefault(publisher_id, [])
+        if any(s.handler == handler for s in subscriptions):
+            return
+        subscriptions.append(_Subscription(handler, name, maxlen, policy))
 
+    def unsubscribe(self, handler, publisher_id):
+        subscriptions = _subscriptions.get(publisher_id, [])
+        for subscription in list(subscriptions):
+            if subscription.handler == handler:
+                subscription.close()
+                subscriptions.remove(subscription)
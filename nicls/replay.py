@@ -0,0 +1,237 @@
+''' Offline replay of recorded EEG through the classifier.
+
+ReplaySource publishes a recorded session exactly like BioSemiListener
+does, so anything that subscribes to the biosemi publisher can be driven
+from a file, at real time, N times real time, or as fast as possible.
+
+Run as a script to classify a whole recording and optionally diff the
+CLASSIFIER_RESULT stream against a reference run:
+
+    python -m nicls.replay config.json session_eeg.bin --speed 0 \
+        --out results.jsonl --reference reference.jsonl
+'''
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+import numpy as np
+
+from nicls.biosemi_listener import SAMPLES
+from nicls.configuration import load_configuration, Config
+from nicls.eeg_recorder import load_recording
+from nicls.latency import EpochTrace
+from nicls.pubsub import Publisher, Subscriber
+
+
+def load_session(path):
+    ''' Recorded samples from an EEGRecorder file or a .npy array.
+
+    :return: tuple of (samplerate or None, (samples, channels) array)
+    '''
+    if str(path).endswith(".npy"):
+        return None, np.load(path, mmap_mode='r')
+    header, data = load_recording(path)
+    return header["samplerate"], data
+
+
+class ReplaySource(Publisher):
+    def __init__(self, path, samplerate=None, speed=1.0, packet=SAMPLES,
+                 wait=None, channels=None):
+        '''
+        :param path: EEGRecorder file or .npy file of (samples, channels)
+        :param samplerate: samples / second, required for .npy files.
+            EEGRecorder files carry their own, which must match if given.
+        :param speed: multiple of real time, 0 to publish as fast as
+            possible
+        :param packet: samples per published packet
+        :param wait: optional coroutine function awaited before every
+            packet, for subscribers that need to apply backpressure
+        :param channels: if given, the number of channels the recording
+            must have
+        '''
+        super().__init__("BIOSEMI")
+        recorded_rate, self.data = load_session(path)
+        if recorded_rate is not None and samplerate is not None and \
+                recorded_rate != samplerate:
+            raise ValueError(f"{path} was recorded at {recorded_rate:g} Hz, "
+                             f"not {samplerate:g} Hz")
+        self.samplerate = recorded_rate or samplerate
+        if self.samplerate is None:
+            raise ValueError("samplerate is needed to replay a .npy file")
+        self.channels = self.data.shape[1]
+        if channels is not None and self.channels != channels:
+            raise ValueError(f"{path} has {self.channels} channels, "
+                             f"not {channels}")
+        self.speed = speed
+        self.packet = packet
+        self.wait = wait
+        self.samples_sent = 0
+        self.finished = None
+
+    async def connect(self):
+        logging.debug("starting eeg replay")
+        self.finished = asyncio.get_running_loop().create_future()
+        asyncio.create_task(self.listen())  # Task not awaited
+
+    async def listen(self):
+        ''' Publish the recording one packet at a time, paced to speed.
+        finished gets the number of samples sent, or the exception that
+        stopped the replay, such as a subscriber failing.
+        '''
+        try:
+            samples = await self._listen()
+        except asyncio.CancelledError:
+            self.finished.cancel()
+            raise
+        except Exception as e:
+            self.finished.set_exception(e)
+        else:
+            self.finished.set_result(samples)
+
+    async def _listen(self):
+        start = time.monotonic()
+        total = len(self.data) - len(self.data) % self.packet
+        for i in range(0, total, self.packet):
+            if self.wait is not None:
+                await self.wait()
+            if self.speed:
+                due = start + i / (self.samplerate * self.speed)
+                await asyncio.sleep(max(0, due - time.monotonic()))
+            else:
+                # let the subscribers' tasks run between packets
+                await asyncio.sleep(0)
+            read = time.monotonic()
+            samples = np.asarray(self.data[i:i + self.packet])
+            trace = EpochTrace(read=read, parse=time.monotonic())
+            # subscribers see the position including this packet
+            self.samples_sent = i + self.packet
+            self.publish(samples, log_msg="replayed data", no_log=True,
+                         trace=trace)
+            await self.backpressure()
+        logging.info(f"replayed {self.samples_sent} samples in "
+                     f"{time.monotonic() - start:.2f}s")
+        return self.samples_sent
+
+
+class ResultCollector(Subscriber):
+    ''' Gathers classifier output along with the replay position of each
+    epoch
+    '''
+
+    def __init__(self, classifier_publisher_id, source):
+        self.source = source
+        self.epoch_samples = {}
+        self.results = []
+        self.subscribe(self.classifier_receiver, classifier_publisher_id,
+                       name_in_log="ResultCollector")
+
+    def classifier_receiver(self, message, **kwargs):
+        if "EEG_EPOCH_END" in message:
+            epoch = message["EEG_EPOCH_END"]
+            self.epoch_samples[epoch["id"]] = self.source.samples_sent
+        elif "CLASSIFIER_RESULT" in message:
+            result = message["CLASSIFIER_RESULT"]
+            self.results.append({"id": result["id"],
+                                 "sample": self.epoch_samples.get(result["id"]),
+                                 "result": result["result"],
+                                 "probability": float(result["probability"])})
+
+
+def diff_results(results, reference, tolerance=1e-6):
+    ''' Compare two result lists by epoch id.
+
+    :return: list of human readable differences
+    '''
+    expected = {r["id"]: r for r in reference}
+    diffs = []
+    for r in results:
+        ref = expected.pop(r["id"], None)
+        if ref is None:
+            diffs.append(f"epoch {r['id']}: not in reference")
+        elif r["sample"] != ref["sample"] or r["result"] != ref["result"] or \
+                abs(r["probability"] - ref["probability"]) > tolerance:
+            diffs.append(f"epoch {r['id']}: {r} != {ref}")
+    diffs.extend(f"epoch {i}: missing" for i in sorted(expected))
+    return diffs
+
+
+async def replay(path, speed=0, lockstep=True):
+    ''' Classify a recording with the configured classifier.
+
+    :param lockstep: hold the replay while the classifier is at its in
+        flight limit, so no epoch is dropped and the results only depend
+        on the data
+    :return: tuple of (results, seconds taken, samples replayed)
+    '''
+    # importing here keeps the source usable without the classifier
+    from nicls.classifier import Classifier
+
+    Classifier.setup_process_pool(Config.system.cores)
+    classifier = None
+
+    async def wait_for_classifier():
+        scheduler = classifier.scheduler
+        while scheduler.in_flight >= scheduler.max_in_flight:
+            await asyncio.sleep(0.001)
+
+    source = ReplaySource(path, Config.biosemi.samplerate, speed,
+                          wait=wait_for_classifier if lockstep else None,
+                          channels=Config.biosemi.channels)
+    classifier = Classifier(source.publisher_id,
+                            Config.classifier.secsdatabuffered,
+                            Config.classifier.samplerate,
+                            Config.classifier.datarate,
+                            Config.classifier.classiffreq,
+                            warm_start=False)
+    collector = ResultCollector(classifier.publisher_id, source)
+
+    start = time.monotonic()
+    await source.connect()
+    samples = await source.finished
+    while classifier.scheduler.backlog:
+        await asyncio.sleep(0.01)
+    # let the last results be delivered
+    await asyncio.sleep(0)
+    return collector.results, time.monotonic() - start, samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("config", help="NICLS config file")
+    parser.add_argument("recording", help="EEGRecorder file or .npy array")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="multiple of real time, 0 for unthrottled")
+    parser.add_argument("--no-lockstep", action="store_true",
+                        help="never hold the replay for the classifier")
+    parser.add_argument("--out", help="write results as JSON lines")
+    parser.add_argument("--reference", help="JSON lines results to diff")
+    parser.add_argument("--tolerance", type=float, default=1e-6,
+                        help="allowed probability difference")
+    args = parser.parse_args(argv)
+
+    load_configuration(args.config)
+    results, seconds, samples = asyncio.run(
+        replay(args.recording, args.speed, not args.no_lockstep))
+
+    recorded = samples / Config.biosemi.samplerate
+    print(f"{len(results)} results from {recorded:.1f}s of eeg in "
+          f"{seconds:.1f}s ({recorded / seconds:.1f}x real time)")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.writelines(json.dumps(r) + "\n" for r in results)
+    if args.reference:
+        with open(args.reference) as f:
+            reference = [json.loads(line) for line in f if line.strip()]
+        diffs = diff_results(results, reference, args.tolerance)
+        for d in diffs:
+            print(d)
+        print(f"{len(diffs)} differences from {args.reference}")
+        return 1 if diffs else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
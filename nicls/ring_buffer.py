@@ -0,0 +1,90 @@
+import numpy as np
+
+
+class RingBuffer:
+    ''' Fixed size circular buffer of multichannel samples.
+
+    Storage is a preallocated (samples, channels) array with a write
+    cursor, so appending never allocates and a snapshot of the whole
+    window costs at most one copy.
+    '''
+
+    def __init__(self, samples, channels, dtype=np.float64):
+        self._data = np.zeros((samples, channels), dtype=dtype)
+        self._cursor = 0  # next row to write
+        self._count = 0  # total samples ever written
+
+    @property
+    def maxlen(self):
+        return self._data.shape[0]
+
+    @property
+    def shape(self):
+        return self._data.shape
+
+    @property
+    def channels(self):
+        return self._data.shape[1]
+
+    @property
+    def total_samples(self):
+        ''' Number of samples appended since the buffer was created
+        '''
+        return self._count
+
+    def __len__(self):
+        return min(self._count, self.maxlen)
+
+    def is_full(self):
+        return self._count >= self.maxlen
+
+    def append(self, block):
+        ''' Append a block of samples.
+
+        :param block: array with shape (samples, channels)
+        :return: None
+        '''
+        block = np.asarray(block)
+        n = block.shape[0]
+        if n >= self.maxlen:
+            # only the most recent samples survive
+            self._data[:] = block[n - self.maxlen:]
+            self._cursor = 0
+        else:
+            end = self._cursor + n
+            if end <= self.maxlen:
+                self._data[self._cursor:end] = block
+            else:
+                split = self.maxlen - self._cursor
+                self._data[self._cursor:] = block[:split]
+                self._data[:end - self.maxlen] = block[split:]
+            self._cursor = end % self.maxlen
+        self._count += n
+
+    def view(self):
+        ''' Zero copy view of the window in chronological order, or
+        None if the window currently wraps around the end of storage.
+        The view is overwritten by later appends.
+        '''
+        if self._count < self.maxlen:
+            return self._data[:self._count]
+        if self._cursor == 0:
+            return self._data
+        return None
+
+    def snapshot(self, out=None):
+        ''' Contiguous copy of the window in chronological order.
+
+        :param out: optional preallocated array to copy into
+        :return: np.array with shape (samples, channels)
+        '''
+        size = len(self)
+        if out is None:
+            out = np.empty((size, self.channels), dtype=self._data.dtype)
+        if self._count < self.maxlen or self._cursor == 0:
+            out[:] = self._data[:size]
+        else:
+            split = self.maxlen - self._cursor
+            out[:split] = self._data[self._cursor:]
+            out[split:] = self._data[:self._cursor]
+        return out
@@ -0,0 +1,96 @@
+import logging
+
+
+class EpochScheduler:
+    ''' Decides when to cut a classification epoch from the incoming
+    samples and limits how many epochs are being classified at once.
+
+    When an epoch is due while max_in_flight are still running, the
+    policy decides what happens to it:
+        "drop": the epoch is skipped
+        "coalesce": the epoch waits and is started as soon as a running
+            one finishes, with the newest data at that time. Only one
+            epoch waits, so a newer one replaces it and the older counts
+            as dropped.
+    '''
+    POLICIES = ("drop", "coalesce")
+
+    def __init__(self, launch, interval, max_in_flight=1,
+                 policy="coalesce"):
+        '''
+        :param launch: function called with no arguments to start an epoch
+        :param interval: samples between epochs
+        :param max_in_flight: most epochs being classified at once
+        :param policy: "drop" or "coalesce"
+        '''
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown scheduler policy {policy}, "
+                             f"expected one of {self.POLICIES}")
+        self._launch = launch
+        self.interval = max(1, int(interval))
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.policy = policy
+
+        self._since_epoch = 0
+        self.in_flight = 0
+        self.pending = False
+        self.launched = 0
+        self.dropped = 0
+
+    @property
+    def backlog(self):
+        ''' Epochs started or waiting that have not finished
+        '''
+        return self.in_flight + int(self.pending)
+
+    def advance(self, samples):
+        ''' Count newly arrived samples, starting an epoch when one is due.
+        A block spanning several intervals starts one epoch, and the
+        other intervals count as dropped.
+        '''
+        self._since_epoch += samples
+        if self._since_epoch < self.interval:
+            return
+        # a large block can span several intervals, only the newest gets
+        # an epoch
+        skipped = self._since_epoch // self.interval - 1
+        self._since_epoch %= self.interval
+        if skipped:
+            self._drop(skipped)
+
+        if self.in_flight < self.max_in_flight:
+            self._start()
+        elif self.policy == "coalesce":
+            if self.pending:
+                self._drop()
+            self.pending = True
+        else:
+            self._drop()
+
+    def done(self):
+        ''' Mark a running epoch as finished
+        '''
+        self.in_flight -= 1
+        if self.pending and self.in_flight < self.max_in_flight:
+            self.pending = False
+            self._start()
+
+    def reset(self):
+        ''' Forget the pending epoch and restart the interval count
+        '''
+        self._since_epoch = 0
+        self.pending = False
+
+    def _start(self):
+        self.in_flight += 1
+        self.launched += 1
+        self._launch()
+
+    def _drop(self, count=1):
+        before = self.dropped
+        self.dropped += count
+        # warn on the first drop and every 1000th after
+        if before == 0 or self.dropped // 1000 > before // 1000:
+            logging.warning(f"Classifier behind, dropped epoch "
+                            f"({self.dropped} dropped, {self.in_flight} "
+                            "in flight)")
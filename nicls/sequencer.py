@@ -0,0 +1,97 @@
+import logging
+import time
+
+
+class ResultSequencer:
+    ''' Sits between the classification tasks and the CLASSIFIER_RESULT
+    publish, since tasks can finish out of order.
+
+    Policies:
+        "ordered": results are delivered strictly in data_id order, a
+            result waits until every earlier epoch has delivered or failed
+        "newest": a result is only delivered if it is newer than the last
+            one delivered, otherwise it is dropped
+        "deadline": results are delivered as they finish unless they are
+            older than deadline seconds, measured from EEG_EPOCH_END
+
+    The age of every delivered result, from EEG_EPOCH_END to delivery, is
+    added to the result as "age".
+    '''
+    POLICIES = ("ordered", "newest", "deadline")
+
+    def __init__(self, deliver, policy="ordered", deadline=None,
+                 dropped=None):
+        '''
+        :param deliver: function called with the result dict to send it
+        :param policy: "ordered", "newest" or "deadline"
+        :param deadline: seconds, required for the "deadline" policy
+        :param dropped: optional function called with the data_id of
+            every result the policy drops
+        '''
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown result policy {policy}, "
+                             f"expected one of {self.POLICIES}")
+        if policy == "deadline" and deadline is None:
+            raise ValueError("The deadline policy needs a deadline")
+        self._deliver = deliver
+        self._dropped = dropped
+        self.policy = policy
+        self.deadline = deadline
+
+        self._started = {}  # data_id -> monotonic EEG_EPOCH_END time
+        self._waiting = {}  # data_id -> result, for the ordered policy
+        self._last_delivered = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def epoch_started(self, data_id):
+        self._started[data_id] = time.monotonic()
+
+    def age(self, data_id):
+        ''' Seconds since EEG_EPOCH_END for an epoch still being tracked
+        '''
+        return time.monotonic() - self._started[data_id]
+
+    def result(self, data_id, result: dict):
+        ''' Hand over the result of an epoch for delivery
+        '''
+        if self.policy == "ordered":
+            self._waiting[data_id] = result
+            self._release()
+        elif self.policy == "newest" and data_id < self._last_delivered:
+            self._drop(data_id, "newer result already sent")
+        elif self.policy == "deadline" and self.age(data_id) > self.deadline:
+            self._drop(data_id, f"older than {self.deadline}s")
+        else:
+            self._send(data_id, result)
+
+    def cancel(self, data_id):
+        ''' Stop waiting on an epoch that will never have a result
+        '''
+        self._started.pop(data_id, None)
+        self._waiting.pop(data_id, None)
+        if self.policy == "ordered":
+            self._release()
+
+    def _release(self):
+        while self._started:
+            oldest = min(self._started)
+            if oldest not in self._waiting:
+                return
+            self._send(oldest, self._waiting.pop(oldest))
+
+    def _send(self, data_id, result):
+        result["age"] = self.age(data_id)
+        del self._started[data_id]
+        self._last_delivered = max(self._last_delivered, data_id)
+        self.delivered += 1
+        self._deliver(result)
+
+    def _drop(self, data_id, reason):
+        del self._started[data_id]
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logging.warning(f"Dropped classifier result {data_id}: "
+                            f"{reason} ({self.dropped} dropped)")
+        if self._dropped is not None:
+            self._dropped(data_id)
@@ -0,0 +1,82 @@
+import logging
+import numpy as np
+
+from collections import deque
+from multiprocessing.shared_memory import SharedMemory
+
+# slot arrays attached in a worker process by attach_windows
+_worker_windows = None
+
+
+class SharedWindowPool:
+    ''' Fixed set of shared memory slots, each holding one
+    (samples, channels) EEG window.
+
+    The classifier copies a window into a free slot and only sends the
+    slot index to the process pool, so the window is never pickled.
+    The slot is released once the worker is done with it.
+    '''
+
+    def __init__(self, slots, shape, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._segments = [SharedMemory(create=True, size=nbytes)
+                          for _ in range(slots)]
+        self._arrays = [np.ndarray(self.shape, dtype=self.dtype,
+                                   buffer=shm.buf)
+                        for shm in self._segments]
+        self._free = deque(range(slots))
+
+    @property
+    def names(self):
+        return [shm.name for shm in self._segments]
+
+    def initargs(self):
+        ''' Arguments for attach_windows, to be used as the process
+        pool initializer arguments
+        '''
+        return (self.names, self.shape, self.dtype.str)
+
+    def acquire(self):
+        ''' Reserve a free slot.
+
+        :return: slot index, or None if every slot is in use
+        '''
+        if not self._free:
+            return None
+        return self._free.popleft()
+
+    def release(self, slot):
+        self._free.append(slot)
+
+    def array(self, slot):
+        return self._arrays[slot]
+
+    def close(self):
+        self._arrays = []
+        for shm in self._segments:
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        self._segments = []
+        logging.debug("shared window pool closed")
+
+
+def attach_windows(names, shape, dtype):
+    ''' Process pool initializer that maps every slot of a
+    SharedWindowPool into the worker once.
+    '''
+    global _worker_windows
+    segments = [SharedMemory(name=name) for name in names]
+    _worker_windows = [(shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+                       for shm in segments]
+
+
+def worker_window(slot):
+    ''' Array for a slot inside a worker. Only valid until the slot
+    is released by the owning process.
+    '''
+    return _worker_windows[slot][1]
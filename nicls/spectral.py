@@ -0,0 +1,377 @@
+import numpy as np
+
+from scipy import fft
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
+
+# engines already built in this process, keyed by their parameters
+_engines = {}
+
+# upper bound on the complex intermediate of one batched convolution,
+# frequencies are split into batches that fit
+MAX_BATCH_BYTES = 64 * 2**20
+
+
+def preprocessing_sos(samplerate):
+    ''' Second order sections for the preprocessing filters: a 58-62 Hz
+    bandstop for line noise and a 0.5 Hz highpass to ignore drift.
+
+    :return: tuple of (notch, highpass) sos arrays
+    '''
+    nyq = samplerate / 2
+    notch = butter(4, np.array([58, 62]) / nyq, 'bandstop', output='sos')
+    highpass = butter(4, 0.5 / nyq, 'highpass', output='sos')
+    return notch, highpass
+
+
+def morlet_wavelet(freq, width, samplerate):
+    ''' Complex Morlet wavelet with unit energy, truncated at 3.5 standard
+    deviations of its gaussian envelope.
+
+    :param freq: center frequency in Hz
+    :param width: number of cycles
+    :param samplerate: samples / second
+    :return: np.array with odd length, centered on the middle sample
+    '''
+    st = width / (2 * np.pi * freq)
+    half = int(3.5 * st * samplerate)
+    t = np.arange(-half, half + 1) / samplerate
+    norm = 1 / np.sqrt(st * np.sqrt(np.pi))
+    return norm * np.exp(-t ** 2 / (2 * st ** 2)) * np.exp(2j * np.pi * freq * t)
+
+
+def frequencies(freq_specs):
+    ''' Wavelet frequencies for a [low, high, count] spec, log spaced.
+    Features are ordered frequency major, every channel at the first
+    frequency, then every channel at the next.
+    '''
+    return np.logspace(np.log10(freq_specs[0]), np.log10(freq_specs[1]),
+                       freq_specs[2])
+
+
+# feature pipelines selectable with classifier.powerengine. "ptsa" is the
+# chain the classifier models were trained on, "numpy" is PowerEngine,
+# which reimplements it with cached kernels. Run
+# benchmarks/validate_powers.py on recorded data before switching a
+# trained model to "numpy".
+POWER_ENGINES = ("ptsa", "numpy")
+
+
+def check_power_engine(name):
+    ''' Raise if the feature pipeline is unknown or can't run here
+    '''
+    if name not in POWER_ENGINES:
+        raise ValueError(f"Unknown power engine {name}, "
+                         f"expected one of {POWER_ENGINES}")
+    if name == "ptsa":
+        try:
+            import ptsa  # noqa: F401
+        except ImportError as e:
+            raise ImportError("The ptsa power engine needs ptsa installed, "
+                              "see the README, or set \"powerengine\": "
+                              "\"numpy\"") from e
+
+
+def ptsa_powers(data, samplerate, freq_specs, wavelet_width,
+                norm: tuple = (0, 1)):
+    ''' Features for one window with the ptsa filters and Morlet wavelets.
+
+    :param data: eeg window with shape samples x channels
+    :param norm: tuple of array-like with (mean, std) for each feature
+    :return: np.array with shape 1 x (freqs x channels)
+    '''
+    # ptsa is an optional dependency, only needed for this engine
+    from ptsa.data.filters import ButterworthFilter, MorletWaveletFilter
+    from ptsa.data.timeseries import TimeSeries
+
+    eeg = TimeSeries(np.asarray(data).T,
+                     coords={'samplerate': samplerate},
+                     dims=['channel', 'time'])
+    # average reference
+    eeg = eeg - eeg.mean("channel")
+    # filter out line noise
+    eeg = ButterworthFilter(eeg, filt_type='stop', freq_range=[58, 62],
+                            order=4).filter()
+    # highpass filter 0.5 Hz to ignore drift
+    eeg = ButterworthFilter(eeg, filt_type='highpass',
+                            freq_range=0.5).filter()
+    freqs = frequencies(freq_specs)
+    # width is really n_cycles, buffer needs to be at least half
+    # the width at the lowest frequency
+    buffer_time = 1 / freq_specs[0] * wavelet_width / 2
+    # one cpu, every pool worker already has a core of its own
+    pows = MorletWaveletFilter(eeg, freqs=freqs, width=wavelet_width,
+                               output='power', cpus=1).filter()
+    pows = pows.remove_buffer(buffer_time).data + \
+        np.finfo(np.float64).eps / 2.
+    avg_pows = np.nanmean(np.log10(pows), -1).reshape((1, -1))
+    return (avg_pows - norm[0]) / norm[1]
+
+
+class PowerEngine:
+    ''' Log wavelet power features for fixed length EEG windows.
+
+    The filter coefficients and the FFT of every wavelet are computed once
+    for a window length, so each call only pays for the filtering and the
+    convolution. All channels and frequencies are convolved with one
+    broadcast multiply against the wavelet bank and one inverse FFT.
+    '''
+
+    def __init__(self, samplerate, n_samples, freq_specs, wavelet_width):
+        self.samplerate = samplerate
+        self.n_samples = n_samples
+        self.freqs = frequencies(freq_specs)
+
+        self._notch, self._highpass = preprocessing_sos(samplerate)
+
+        # width is really n_cycles, buffer needs to be at least half
+        # the width at the lowest frequency
+        buffer_time = 1 / freq_specs[0] * wavelet_width / 2
+        self.buffer = int(np.ceil(buffer_time * samplerate))
+        if 2 * self.buffer >= n_samples:
+            raise ValueError(f"{n_samples} samples is too short for a "
+                             f"{buffer_time}s buffer on each side")
+
+        wavelets = [morlet_wavelet(f, wavelet_width, samplerate)
+                    for f in self.freqs]
+        # all wavelets are centered in a frame of the longest one so they
+        # share the same offset into the full convolution
+        frame = max(len(w) for w in wavelets)
+        self._offset = frame // 2
+        self._nfft = fft.next_fast_len(n_samples + frame - 1)
+        self._kernels = np.zeros((len(wavelets), self._nfft), dtype=complex)
+        for i, w in enumerate(wavelets):
+            start = (frame - len(w)) // 2
+            self._kernels[i, start:start + len(w)] = w
+        self._kernels = fft.fft(self._kernels, axis=-1)
+
+    @property
+    def num_feats_per_channel(self):
+        return len(self.freqs)
+
+    def filter(self, eeg):
+        ''' Average reference and filter a channels x samples array
+        '''
+        eeg = eeg - eeg.mean(axis=0)
+        eeg = sosfiltfilt(self._notch, eeg, axis=-1)
+        return sosfiltfilt(self._highpass, eeg, axis=-1)
+
+    def log_powers(self, eeg):
+        ''' Mean log10 wavelet power of a filtered channels x samples
+        array, excluding the buffer at each end.
+
+        :return: np.array with shape (freqs, channels)
+        '''
+        spectrum = fft.fft(eeg, self._nfft, axis=-1)
+        start = self._offset + self.buffer
+        stop = self._offset + self.n_samples - self.buffer
+        nfreqs = len(self.freqs)
+        batch = max(1, MAX_BATCH_BYTES //
+                    (eeg.shape[0] * self._nfft * spectrum.itemsize))
+        out = np.empty((nfreqs, eeg.shape[0]))
+        for i in range(0, nfreqs, batch):
+            # (freqs, channels, nfft) in one multiply and inverse transform
+            coefs = fft.ifft(self._kernels[i:i + batch, None, :] *
+                             spectrum[None, :, :],
+                             axis=-1)[..., start:stop]
+            pows = coefs.real ** 2 + coefs.imag ** 2 + \
+                np.finfo(np.float64).eps / 2.
+            out[i:i + batch] = np.log10(pows).mean(axis=-1)
+        return out
+
+    def powers(self, data, norm: tuple = (0, 1), prefiltered=False):
+        ''' Normalized features for one window.
+
+        :param data: eeg window with shape samples x channels
+        :param norm: tuple of array-like with (mean, std) for each feature
+        :param prefiltered: data already went through a StreamingFilter
+        :return: np.array with shape 1 x (freqs x channels)
+        '''
+        data = np.asarray(data, dtype=np.float64)
+        if data.shape[0] != self.n_samples:
+            raise ValueError(f"expected {self.n_samples} samples, "
+                             f"got {data.shape[0]}")
+        eeg = data.T if prefiltered else self.filter(data.T)
+        avg_pows = self.log_powers(eeg).reshape((1, -1))
+        return (avg_pows - norm[0]) / norm[1]
+
+
+class StreamingFilter:
+    ''' Causal version of PowerEngine.filter that runs on packets as they
+    arrive. The sosfilt state is kept per channel, so every sample is
+    filtered exactly once no matter how long the classification window is.
+
+    Every filter is applied twice in the forward direction, which gives
+    the same magnitude response as the zero phase batch filter (forward
+    and backward). Only the phase differs, so the wavelet powers match the
+    batch filter once the highpass has settled.
+    '''
+
+    def __init__(self, samplerate, channels):
+        notch, highpass = preprocessing_sos(samplerate)
+        self._sos = np.vstack([notch, notch, highpass, highpass])
+        self._zi_step = sosfilt_zi(self._sos)[:, :, None]
+        self._zi = None
+        self.channels = channels
+
+    def reset(self):
+        self._zi = None
+
+    def filter(self, block):
+        ''' Average reference and filter the next block of samples.
+
+        :param block: array with shape (samples, channels)
+        :return: filtered float64 array with shape (samples, channels)
+        '''
+        block = np.asarray(block, dtype=np.float64)
+        block = block - block.mean(axis=1, keepdims=True)
+        if self._zi is None:
+            # start in steady state for the first sample to limit the
+            # initial transient
+            self._zi = self._zi_step * block[0][None, None, :]
+        out, self._zi = sosfilt(self._sos, block, axis=0, zi=self._zi)
+        return out
+
+
+class IncrementalPowers:
+    ''' Sliding window version of PowerEngine.log_powers for filtered
+    samples that arrive in order.
+
+    Each new sample is convolved with the wavelet bank once, using
+    overlap-save against the last samples seen, and its log power is kept
+    in a ring of per sample powers along with a running sum. The features
+    for the current window then cost only the samples that arrived since
+    the last call, no matter how much the windows overlap.
+
+    The averaged region has the same length as in the batch engine, but
+    it ends half the longest wavelet before the newest sample (where the
+    convolution first has all of its input) instead of one buffer before.
+    '''
+
+    # recompute the running sum from the ring this often, in samples,
+    # to stop floating point drift
+    RESYNC = 2**16
+
+    def __init__(self, samplerate, n_samples, freq_specs, wavelet_width,
+                 channels, block=None):
+        '''
+        :param n_samples: window length in samples, as for PowerEngine
+        :param block: largest number of samples convolved at once, by
+            default a quarter second
+        '''
+        self.channels = channels
+        self.freqs = frequencies(freq_specs)
+        buffer_time = 1 / freq_specs[0] * wavelet_width / 2
+        buffer = int(np.ceil(buffer_time * samplerate))
+        if 2 * buffer >= n_samples:
+            raise ValueError(f"{n_samples} samples is too short for a "
+                             f"{buffer_time}s buffer on each side")
+        self.block = block or int(samplerate / 4)
+
+        wavelets = [morlet_wavelet(f, wavelet_width, samplerate)
+                    for f in self.freqs]
+        self._frame = max(len(w) for w in wavelets)
+        self._bank = np.zeros((len(wavelets), self._frame), dtype=complex)
+        for i, w in enumerate(wavelets):
+            start = (self._frame - len(w)) // 2
+            self._bank[i, start:start + len(w)] = w
+        self._kernels = {}  # FFT of the bank, by transform length
+
+        self._history = np.zeros((channels, self._frame - 1))
+        self._pending = []
+        self._pending_samples = 0
+        self._seen = 0
+
+        averaged = n_samples - 2 * buffer
+        self._ring = np.zeros((averaged, len(self.freqs), channels))
+        self._cursor = 0
+        self._count = 0  # log powers written to the ring
+        self._sum = np.zeros((len(self.freqs), channels))
+        self._since_resync = 0
+
+    def is_ready(self):
+        ''' Whether a whole averaging region has been seen
+        '''
+        convolved = self._seen + self._pending_samples - (self._frame - 1)
+        return convolved >= len(self._ring)
+
+    def append(self, block):
+        ''' Queue filtered samples, convolving once a whole block is queued.
+
+        :param block: array with shape (samples, channels)
+        '''
+        block = np.asarray(block, dtype=np.float64)
+        self._pending.append(block)
+        self._pending_samples += block.shape[0]
+        if self._pending_samples >= self.block:
+            self._flush()
+
+    def _kernel(self, nfft):
+        if nfft not in self._kernels:
+            self._kernels[nfft] = fft.fft(self._bank, nfft, axis=-1)
+        return self._kernels[nfft]
+
+    def _flush(self):
+        if not self._pending:
+            return
+        block = np.concatenate(self._pending).T
+        self._pending, self._pending_samples = [], 0
+        n = block.shape[1]
+        segment = np.concatenate([self._history, block], axis=1)
+        self._history = segment[:, n:]
+        # the first frame - 1 samples have nothing before them
+        skip = max(0, self._frame - 1 - self._seen)
+        self._seen += n
+        if skip >= n:
+            return
+
+        nfft = fft.next_fast_len(segment.shape[1])
+        coefs = fft.ifft(self._kernel(nfft)[:, None, :] *
+                         fft.fft(segment, nfft, axis=-1)[None, :, :],
+                         axis=-1)[..., self._frame - 1 + skip:segment.shape[1]]
+        pows = coefs.real ** 2 + coefs.imag ** 2 + \
+            np.finfo(np.float64).eps / 2.
+        self._push(np.log10(pows).transpose(2, 0, 1))
+
+    def _push(self, log_pows):
+        ''' Add (samples, freqs, channels) log powers to the ring and the
+        running sum, dropping the ones that leave the window
+        '''
+        size = len(self._ring)
+        log_pows = log_pows[-size:]
+        split = size - self._cursor
+        for part in (log_pows[:split], log_pows[split:]):
+            if len(part) == 0:
+                continue
+            slots = slice(self._cursor, self._cursor + len(part))
+            if self._count >= size:
+                self._sum -= self._ring[slots].sum(axis=0)
+            self._ring[slots] = part
+            self._sum += part.sum(axis=0)
+            self._cursor = (self._cursor + len(part)) % size
+            self._count += len(part)
+
+        self._since_resync += len(log_pows)
+        if self._since_resync >= self.RESYNC:
+            self._sum = self._ring[:min(self._count, size)].sum(axis=0)
+            self._since_resync = 0
+
+    def log_powers(self):
+        ''' Mean log10 wavelet power over the current averaging region.
+
+        :return: np.array with shape (freqs, channels)
+        '''
+        self._flush()
+        if self._count < len(self._ring):
+            raise RuntimeError("Not enough samples for a full window yet")
+        return self._sum / len(self._ring)
+
+
+def get_engine(samplerate, n_samples, freq_specs, wavelet_width):
+    ''' PowerEngine for these parameters, built on first use and kept for
+    the lifetime of the process.
+    '''
+    key = (samplerate, n_samples, tuple(freq_specs), wavelet_width)
+    if key not in _engines:
+        _engines[key] = PowerEngine(samplerate, n_samples, freq_specs,
+                                    wavelet_width)
+    return _engines[key]
@@ -7,8 +7,10 @@ from collections import deque
 from nicls.data_logger import DataPoint, get_logger
 from nicls.configuration import Config
 from nicls.biosemi_listener import BioSemiListener
+from nicls.eeg_recorder import EEGRecorder
 from nicls.classifier import Classifier
-from nicls.pubsub import Subscriber 
+from nicls.latency import get_latency_stats
+from nicls.pubsub import Publisher, Subscriber
 
 
 class TaskMessage(DataPoint):
@@ -49,7 +51,7 @@ class TaskServer:
         ''' This creates a persistent server that accepts connections
         from tasks and passes communication off to TaskConnection
         instances for setup of task requirements an communication
-        with task.
+        with task. Every connection shares one Session.
 
         :param host:
         :param port:
@@ -62,6 +64,7 @@ class TaskServer:
         self.port = port
 
         self.server = None
+        self.session = Session()
 
     async def __aenter__(self):
         if self.server is not None:
@@ -69,7 +72,7 @@ class TaskServer:
             return self.server.serve_forever()
 
         logging.info("starting task server")
-        self.server = await asyncio.start_server(TaskServer._accept_connection,
+        self.server = await asyncio.start_server(self._accept_connection,
                                                  self.host,
                                                  self.port)
         return self.server.serve_forever()
@@ -81,35 +84,163 @@ class TaskServer:
         self.server = None
         logging.info("server closed successfully")
 
-    @staticmethod
-    async def _accept_connection(reader, writer):
+    async def _accept_connection(self, reader, writer):
         logging.debug("accepting connection")
         logging.debug("reader: " + str(reader))
         logging.debug("writer: " + str(writer))
-        await TaskConnection(reader, writer).listen()
+        await TaskConnection(reader, writer, self.session).listen()
 
 
-class TaskConnection(Subscriber):
-    def __init__(self, reader, writer):
-        self.reader = reader
-        self.writer = writer
+class Session(Publisher, Subscriber):
+    ''' The acquisition and classification pipeline, shared by every task
+    and monitoring connection.
+
+    The first CONFIGURE starts the biosemi listener and the classifier,
+    later ones (a second client, or the task reconnecting) join the
+    running pipeline. Classifier messages are encoded once and published
+    to the connections, which write them from their own queues.
+    '''
+
+    def __init__(self):
+        super().__init__("SESSION")
+        self.biosemi_source = None
+        self.classifier = None
+        self.recorder = None
+        self._configuring = asyncio.Lock()
+
+    @property
+    def configured(self):
+        return self.classifier is not None
+
+    async def configure(self):
+        async with self._configuring:
+            if self.configured:
+                logging.info("joining the running session")
+                return
+            await self._run_configuration()
+
+    async def log_stats(self):
+        ''' Write the classifier's epoch and result counts to the data
+        log. Meant to be run with repeated_invoke.
+        '''
+        if self.configured:
+            get_logger().log(DataPoint("CLASSIFIER_STATS",
+                                       data=self.classifier.stats()))
 
     def classifier_receiver(self, message, **kwargs):
         logging.info(f"task server received classifier result: {message}")
         message_name = list(message.keys())[0]
         out_message = TaskMessage(message_name, data=message[message_name])
-        asyncio.create_task(self.send(out_message))  # Task not awaited
+        get_logger().log(out_message)
+        self.publish(bytes(out_message), no_log=True,
+                     trace=kwargs.get("trace"))
+
+    async def _run_configuration(self):
+        # Setup Biosemi
+        biosemi_source = BioSemiListener(Config.biosemi.host,
+                                         Config.biosemi.port,
+                                         Config.biosemi.channels,
+                                         Config.biosemi.samplerate)
+
+        # Connect before building anything that subscribes to it, so a
+        # failed attempt leaves nothing behind for a retry to run into
+        try:
+            await biosemi_source.connect()
+        except OSError as e:
+            raise RuntimeError(f"Could not connect to biosemi at "
+                               f"{Config.biosemi.host}:{Config.biosemi.port}"
+                               f": {e}") from e
+        logging.info("task server connected to biosemi listener")
+
+        classifier = recorder = None
+        try:
+            # Setup Classifier
+            # Connor: TODO: if we use different classifier versions or the
+            # like, we'll need subclasses or a factory
+            Classifier.setup_process_pool(Config.system.cores)
+            classifier = Classifier(biosemi_source.publisher_id,
+                                    Config.classifier.secsdatabuffered,
+                                    Config.classifier.samplerate,
+                                    Config.classifier.datarate,
+                                    Config.classifier.classiffreq)
+
+            # Optionally keep the raw eeg for offline analysis
+            config = Config.recorder if hasattr(Config, "recorder") else None
+            if getattr(config, "enabled", False):
+                recorder = EEGRecorder(biosemi_source.publisher_id,
+                                       Config.biosemi.channels,
+                                       Config.biosemi.samplerate,
+                                       getattr(config, "dtype", "int32"))
+        except Exception as e:
+            biosemi_source.close()
+            if classifier is not None:
+                classifier.unsubscribe(classifier.biosemi_receiver,
+                                       biosemi_source.publisher_id)
+            if isinstance(e, OSError):
+                raise RuntimeError(f"Could not start recording: {e}") from e
+            raise
+
+        self.subscribe(self.classifier_receiver, classifier.publisher_id,
+                       name_in_log="Session")
+        self.biosemi_source = biosemi_source
+        self.classifier = classifier
+        self.recorder = recorder
+
+
+class TaskConnection(Subscriber):
+    ''' One client of the task server. Messages from the session are
+    queued per connection, so a slow client only delays itself.
+    '''
+    QUEUE_LEN = 1000
+
+    def __init__(self, reader, writer, session):
+        self.reader = reader
+        self.writer = writer
+        self.session = session
+        self.subscribe(self.session_receiver, session.publisher_id,
+                       name_in_log="TaskConnection",
+                       maxlen=getattr(Config.task, "queuelen", 0) or
+                       self.QUEUE_LEN,
+                       policy=getattr(Config.task, "queuepolicy",
+                                      "drop_oldest"))
+
+    @property
+    def classifier(self):
+        return self.session.classifier
+
+    async def session_receiver(self, message, trace=None, **kwargs):
+        ''' Write an encoded session message to this client
+        '''
+        if self.writer.is_closing():
+            return
+        self.writer.write(message)
+        await self.writer.drain()
+        # the first client to receive a result finishes its latency
+        if trace is not None and "sent" not in trace.times:
+            trace.mark("sent")
+            get_latency_stats().record_trace(trace)
 
     async def listen(self):
+        try:
+            await self._listen()
+        finally:
+            self.unsubscribe(self.session_receiver, self.session.publisher_id)
+            logging.info("task connection closed")
+
+    async def _listen(self):
         while not self.reader.at_eof():
             try:
                 message = await self.reader.readline()
             except asyncio.LimitOverrunError as e:
                 # TODO
                 print(e)
+                continue
             except asyncio.IncompleteReadError as e:
                 # TODO
                 print(e)
+                continue
+            if not message:
+                return  # disconnected
 
             print(message)
             message = TaskMessage.from_bytes(message)
@@ -123,7 +254,7 @@ class TaskConnection(Subscriber):
             elif message.type == 'CONFIGURE':
                 if self._check_configuration(message.data):
                     try:
-                        await self._run_configuration()
+                        await self.session.configure()
                         await self.send(TaskMessage('CONFIGURE_OK', data=Config.get_dict()))
                     except RuntimeError as e:
                         await self.close(TaskMessage('ERROR_IN_CONFIGURATION'))
@@ -134,6 +265,9 @@ class TaskConnection(Subscriber):
                 self.classifier.enable()
             elif message.type == "CLASSIFIER_OFF":
                 self.classifier.disable()
+            elif message.type == "LATENCY_STATS":
+                await self.send(TaskMessage('LATENCY_STATS',
+                                            data=get_latency_stats().summary()))
             if message.type == 'ENCODING':
                 self.classifier.encoding(message.data['enable'])
             elif message.type == 'READ_ONLY_STATE':
@@ -157,25 +291,3 @@ class TaskConnection(Subscriber):
         # TODO
         logging.info("checking configuration")
         return True
-
-    async def _run_configuration(self):
-        # Setup Biosemi
-        self.biosemi_source = BioSemiListener(Config.biosemi.host,
-                                           Config.biosemi.port,
-                                           Config.biosemi.channels)
-
-        # Setup Classifier
-        # Connor: TODO: if we use different classifier versions or the like,
-        # we'll need subclasses or a factory
-        Classifier.setup_process_pool(Config.system.cores)
-        self.classifier = Classifier(self.biosemi_source.publisher_id,
-                                     Config.classifier.secsdatabuffered,
-                                     Config.classifier.samplerate,
-                                     Config.classifier.datarate,
-                                     Config.classifier.classiffreq)
-        self.subscribe(self.classifier_receiver, self.classifier.publisher_id, name_in_log="TaskConnection")
-
-        # Connect to all of the sources
-        await self.biosemi_source.connect()
-        logging.info("task server connected to biosemi listener")
-
@@ -16,11 +16,14 @@ setup(
 
     install_requires=[
         "numpy",
+        "scipy",
         "scikit-learn",
-        "django",
-        "aiofiles",
         "zmq",
     ],
+    extras_require={
+        # faster event loop, selected with "eventloop": "uvloop"
+        "uvloop": ["uvloop"],
+    },
 )
 
 